@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright (C) 2010 Vittorio Palmisano <vpalmisano at gmail dot com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+"""Renders a playlist of irealbook:// songs on a pool of processes.
+
+    python -m parser.batch [options] songs.txt
+
+songs.txt holds one song per line; the output files are named after
+the line number of the song, so a run can be resumed with --start.
+"""
+import os
+import sys
+import time
+import json
+import traceback
+import multiprocessing
+from optparse import OptionParser
+
+from realbook.score import preload_fonts
+from render import render_song, render_song_formats, render_song_keys, \
+    page_sizes
+from realbook.transpose import pitch, transposing_instruments
+from cache import ParseCache, RenderCache
+
+class BatchSummary:
+    def __init__(self):
+        self.rendered = []
+        self.failures = []
+        self.start_time = time.time()
+        self.elapsed = 0
+
+    def add(self, index, filename, elapsed, error):
+        if error:
+            self.failures.append((index, error))
+        else:
+            self.rendered.append((index, filename, elapsed))
+
+    def finish(self):
+        self.elapsed = time.time() - self.start_time
+
+    def throughput(self):
+        if not self.elapsed:
+            return 0.0
+        return len(self.rendered) / self.elapsed
+
+    def as_dict(self):
+        return {
+            'rendered': len(self.rendered),
+            'failed': len(self.failures),
+            'elapsed': self.elapsed,
+            'songs_per_second': self.throughput(),
+            'render_time': sum(r[2] for r in self.rendered),
+            'failures': [{'index': i, 'error': e} for i, e in self.failures],
+        }
+
+    def report(self, out=sys.stderr):
+        out.write('%d songs rendered in %.2fs (%.2f songs/s), %d failed\n' %(
+            len(self.rendered), self.elapsed, self.throughput(),
+            len(self.failures)))
+        for index, error in sorted(self.failures):
+            out.write('song %d failed: %s\n' %(index,
+                error.strip().splitlines()[-1]))
+
+parse_cache = None
+render_cache = None
+
+def init_worker(ttf_dir=None, parse_cache_dir=None, render_cache_dir=None):
+    global parse_cache, render_cache
+    # every worker loads the fonts once and keeps them for all its songs
+    preload_fonts(ttf_dir=ttf_dir)
+    if parse_cache_dir:
+        parse_cache = ParseCache(parse_cache_dir)
+    if render_cache_dir:
+        render_cache = RenderCache(render_cache_dir)
+
+def render_job(job):
+    index, s, outdir, fmt, keys, instruments, dpi = job
+    t = time.time()
+    try:
+        if keys or instruments:
+            # one parse of the song for all its keys
+            filename = ', '.join(render_song_keys(s, outdir, index, keys,
+                instruments, fmt.split(','), cache=parse_cache, dpi=dpi))
+        elif ',' in fmt:
+            # several formats replayed from a single drawing of the song
+            filename = ', '.join(render_song_formats(s, outdir, index,
+                fmt.split(','), cache=parse_cache, scale=dpi / 100.0))
+        else:
+            filename = render_song(s, outdir, index, fmt, cache=parse_cache,
+                render_cache=render_cache, dpi=dpi)
+    except Exception:
+        return index, None, time.time() - t, traceback.format_exc()
+    return index, filename, time.time() - t, None
+
+def read_playlist(filename):
+    f = open(filename)
+    try:
+        return f.read().split('\n')
+    finally:
+        f.close()
+
+def render_playlist(songs, outdir='pdf', fmt='pdf', processes=None,
+                    start=0, stop=None, ttf_dir=None, progress=None,
+                    parse_cache_dir=None, render_cache_dir=None, keys=(),
+                    instruments=(), dpi=100):
+    """Renders songs[start:stop] on ``processes`` worker processes.
+
+    With ``keys`` or ``instruments`` each song is also rendered in those
+    keys, see realbook.transpose.transpositions.
+
+    A failing song does not stop the batch: its traceback is collected
+    in the returned BatchSummary.
+    """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    if stop is None:
+        stop = len(songs)
+    jobs = [(i, songs[i], outdir, fmt, keys, instruments, dpi)
+        for i in xrange(start, min(stop, len(songs))) if songs[i].strip()]
+    summary = BatchSummary()
+    pool = multiprocessing.Pool(processes, init_worker,
+        (ttf_dir, parse_cache_dir, render_cache_dir))
+    try:
+        for result in pool.imap_unordered(render_job, jobs):
+            summary.add(*result)
+            if progress:
+                progress(*result)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    summary.finish()
+    return summary
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] songs.txt')
+    parser.add_option('-o', '--output', default='pdf',
+        help='output directory [%default]')
+    parser.add_option('-f', '--format', default='pdf',
+        help='output format: pdf, png, svg or a comma separated list of '
+             'them [%default]')
+    parser.add_option('-j', '--jobs', type='int', default=None,
+        help='number of worker processes [number of cpus]')
+    parser.add_option('--start', type='int', default=0,
+        help='index of the first song to render [%default]')
+    parser.add_option('--stop', type='int', default=None,
+        help='index of the song where to stop (excluded)')
+    parser.add_option('--ttf-dir', default=None,
+        help='directory of the Jazz fonts')
+    parser.add_option('--parse-cache', default=None,
+        help='directory of the cache of the parsed songs')
+    parser.add_option('--render-cache', default=None,
+        help='directory of the cache of the rendered files, for a single '
+             'format')
+    parser.add_option('--summary', default=None,
+        help='write the json summary of the run to this file')
+    parser.add_option('--dpi', type='int', default=100,
+        help='resolution of the png files, drawn in bands above 100 when '
+             'png is the only format [%default]')
+    parser.add_option('--keys', default='',
+        help='comma separated tonics to transpose the songs to, or all '
+             'for the 12 keys')
+    parser.add_option('--instruments', default='',
+        help='comma separated transposing instruments (C, Bb, Eb, F) to '
+             'write the songs for')
+    parser.add_option('-q', '--quiet', action='store_true', default=False)
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('a playlist file is required')
+    for fmt in options.format.split(','):
+        if fmt not in page_sizes:
+            parser.error('unknown output format: %s' %fmt)
+    if options.dpi <= 0:
+        parser.error('the dpi must be positive')
+    if options.render_cache and (',' in options.format or options.keys or
+                                 options.instruments):
+        parser.error('--render-cache only applies to a single format, '
+            'without --keys or --instruments')
+    keys = [k for k in options.keys.split(',') if k]
+    for key in keys:
+        try:
+            key == 'all' or pitch(key)
+        except (KeyError, IndexError):
+            parser.error('unknown key: %s' %key)
+    instruments = [i for i in options.instruments.split(',') if i]
+    for instrument in instruments:
+        if instrument not in transposing_instruments:
+            parser.error('unknown instrument: %s' %instrument)
+    def progress(index, filename, elapsed, error):
+        if error:
+            sys.stderr.write('%03d FAILED\n' %index)
+        elif not options.quiet:
+            sys.stderr.write('%03d %s (%.2fs)\n' %(index, filename, elapsed))
+    summary = render_playlist(read_playlist(args[0]), options.output,
+        options.format, options.jobs, options.start, options.stop,
+        options.ttf_dir, progress, options.parse_cache, options.render_cache,
+        keys, instruments, options.dpi)
+    summary.report()
+    if options.summary:
+        f = open(options.summary, 'w')
+        try:
+            json.dump(summary.as_dict(), f, indent=2)
+        finally:
+            f.close()
+    return summary.failures and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright (C) 2010 Vittorio Palmisano <vpalmisano at gmail dot com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+"""Benchmarks the parser, the layout and the renderers on a synthetic corpus.
+
+    python -m parser.bench [options]
+
+The corpus is generated from a seed, so two runs with the same options
+time the same songs. Between them the songs use every quality of
+chord_table, every barline, endings, sections, the % x r repeats and
+long comments. Each phase is timed separately:
+
+    decode      url unquoting of the irealbook:// string
+    parse       IRealBookParser, string to Song
+    layout      MusicScore.load_song and MusicScore.layout
+    pdf         MusicScore.render of the layout on a PDFSurface
+    png         MusicScore.render of the layout on an ImageSurface and
+                write_to_png
+
+The results are written as json with --json and can be compared with
+those of an earlier run with --compare. With --memory the bytes used
+per measure and per chord are reported instead.
+"""
+import sys
+import time
+import json
+import random
+import urllib
+import resource
+from optparse import OptionParser
+from cStringIO import StringIO
+
+from realbook.chord import chord_table
+from realbook.metrics import text_metrics
+from realbook.skyline import Skyline
+from realbook.staff import Staff
+from irealbook import IRealBookParser
+from render import decode_song, page_sizes
+
+PHASES = ('decode', 'parse', 'layout', 'pdf', 'png')
+
+# bump when the corpus, the timed code or the json layout change, runs
+# of different versions are not comparable
+BENCH_VERSION = 2
+
+roots = ('C', 'Db', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'Ab', 'A', 'Bb', 'B')
+keys = ('C', 'F', 'Bb', 'Eb', 'G', 'D', 'A', 'Am', 'Dm', 'Gm', 'Cm', 'Em')
+sections = ('*A', '*B', '*C', '*D', '*i')
+
+class Corpus:
+    """Generates the synthetic songs.
+
+    The qualities of chord_table are handed out in turn across all the
+    songs, so a corpus with enough chords uses each of them.
+    """
+    def __init__(self, seed=0, measures=32, comment_length=200):
+        self.rnd = random.Random(seed)
+        self.measures = measures
+        self.comment_length = comment_length
+        self.qualities = sorted(chord_table)
+        self.count = 0
+
+    def chord(self):
+        rnd = self.rnd
+        quality = self.qualities[self.count % len(self.qualities)]
+        self.count += 1
+        chord = rnd.choice(roots) + quality
+        if rnd.random() < 0.1:
+            chord += '/' + rnd.choice(roots)
+        if rnd.random() < 0.05:
+            chord = 'f' + chord
+        elif rnd.random() < 0.1:
+            chord = 's' + chord
+        elif rnd.random() < 0.05:
+            chord = 'l' + chord
+        elif rnd.random() < 0.05:
+            chord += '(%s7)' %rnd.choice(roots)
+        return chord
+
+    def measure(self):
+        rnd = self.rnd
+        r = rnd.random()
+        if r < 0.05:
+            return 'x '
+        elif r < 0.1:
+            return '% '
+        elif r < 0.13:
+            # the symbols are placed on the chord slots, a measure holding
+            # nothing but r has none
+            return self.chord() + ' r'
+        elif r < 0.16:
+            return 'S ' + self.chord() + ' '
+        elif r < 0.18:
+            return 'Q ' + self.chord() + ' '
+        return ' '.join(self.chord() for i in xrange(rnd.choice((1, 1, 2, 4)))) + ' '
+
+    def comment(self):
+        words = ('play', 'last', 'time', 'only', 'solos', 'on', 'AABA', 'fine',
+            'al', 'coda', 'D.C.', 'fade', 'out', 'vamp', 'ad', 'lib.')
+        text = []
+        while len(' '.join(text)) < self.comment_length:
+            text.append(self.rnd.choice(words))
+        return '<%s>' %' '.join(text)[:self.comment_length]
+
+    def block(self, index, size):
+        rnd = self.rnd
+        parts = [sections[index % len(sections)]]
+        if index == 0:
+            parts.append('T44')
+        elif rnd.random() < 0.2:
+            parts.append(rnd.choice(('T34', 'T44', 'T68')))
+        bars = [self.measure() for i in xrange(size)]
+        if self.comment_length and rnd.random() < 0.5:
+            i = rnd.randrange(size)
+            bars[i] = self.comment() + bars[i]
+        kind = index % 3
+        if kind == 0:
+            # repeated block with first and second endings
+            return '{%s%s|N1%s}N2%s]' %(''.join(parts), '|'.join(bars[:-2]),
+                bars[-2], bars[-1])
+        elif kind == 1:
+            return '[%s%s]' %(''.join(parts), '|'.join(bars))
+        return '|%s%s|' %(''.join(parts), '|'.join(bars))
+
+    def song(self, index):
+        rnd = self.rnd
+        blocks, left = [], self.measures
+        while left > 0:
+            size = min(left, rnd.choice((4, 8)))
+            if size < 3:
+                size = 3
+            blocks.append(self.block(len(blocks), size))
+            left -= size
+        return 'irealbook://Synthetic %d=Benchmark=Swing=%s=n=%sZ' %(index,
+            keys[index % len(keys)], ''.join(blocks))
+
+    def songs(self, count):
+        """Returns ``count`` url quoted irealbook:// strings."""
+        return [urllib.quote(self.song(i), safe=':/') for i in xrange(count)]
+
+def coverage(songs):
+    """What the parsed songs use: qualities, barlines, endings, symbols."""
+    qualities, barlines, endings, sections, symbols = set(), set(), set(), set(), set()
+    for song in songs:
+        for m in song.measures:
+            barlines.add(m.start_barline)
+            barlines.add(m.stop_barline)
+            if m.ending:
+                endings.add(m.ending)
+            if m.section:
+                sections.add(m.section)
+            for c in m.chords:
+                if c.symbol is not None:
+                    qualities.add(c.symbol.quality)
+            for s in m.symbols:
+                symbols.add(len(s.symbol) > 10 and 'comment' or s.symbol)
+    qualities.discard('')
+    return {
+        'qualities': len(qualities),
+        'missing_qualities': sorted(set(chord_table) - qualities),
+        'barlines': sorted(barlines),
+        'endings': sorted(endings),
+        'sections': sorted(sections),
+        'symbols': sorted(symbols),
+    }
+
+def max_rss():
+    """Peak resident size of the process in kB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss
+
+def bench_song(s, phases=PHASES):
+    """Runs the phases on one song, returns the seconds spent in each,
+    the growth of the peak memory in each and the parsed song."""
+    import cairo
+    from realbook.score import MusicScore
+    times, rss = {}, {}
+    def timed(phase, f, *args):
+        m = max_rss()
+        t = time.time()
+        result = f(*args)
+        times[phase] = time.time() - t
+        rss[phase] = max_rss() - m
+        return result
+    s = timed('decode', decode_song, s)
+    song = timed('parse', lambda s: IRealBookParser(None, s).song, s)
+    def layout(w, h):
+        score = MusicScore()
+        score.load_song(song)
+        return score, score.layout(w, h)
+    if 'layout' in phases or 'pdf' in phases:
+        score, root = timed('layout', layout, *page_sizes['pdf'])
+    if 'pdf' in phases:
+        def pdf(w, h):
+            surface = cairo.PDFSurface(StringIO(), w, h)
+            cr = cairo.Context(surface)
+            # the glyph runs, like render_score
+            score.render(root, cr)
+            cr.show_page()
+            surface.finish()
+        timed('pdf', pdf, *page_sizes['pdf'])
+    if 'png' in phases:
+        w, h = page_sizes['png']
+        # laid out again for the png page size, outside of the timings
+        score, root = layout(w, h)
+        def png():
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(w), int(h))
+            score.render(root, cairo.Context(surface))
+            surface.write_to_png(StringIO())
+        timed('png', png)
+    return times, rss, song
+
+def summarize(values):
+    values = sorted(values)
+    n = len(values)
+    if not n:
+        return {}
+    return {
+        'total_ms': sum(values) * 1000,
+        'mean_ms': sum(values) / n * 1000,
+        'median_ms': values[n // 2] * 1000,
+        'p95_ms': values[min(n - 1, int(n * 0.95))] * 1000,
+        'max_ms': values[-1] * 1000,
+    }
+
+def run(count=20, measures=32, seed=0, comment_length=200, repeat=3,
+        phases=PHASES, progress=None):
+    """Benchmarks ``count`` synthetic songs, returns the json results.
+
+    Each song is run ``repeat`` times and the best time of each phase is
+    kept. The text metrics cache is cleared before every run, so the
+    layout times include the measuring of the text.
+    """
+    corpus = Corpus(seed, measures, comment_length)
+    songs = corpus.songs(count)
+    results, parsed = [], []
+    rss = dict((phase, 0) for phase in PHASES)
+    for i, s in enumerate(songs):
+        best = {}
+        for r in xrange(repeat):
+            text_metrics.clear()
+            times, growth, song = bench_song(s, phases)
+            for phase, t in times.items():
+                best[phase] = min(best.get(phase, t), t)
+                rss[phase] += growth[phase]
+        parsed.append(song)
+        result = {
+            'index': i,
+            'chars': len(s),
+            'measures': len(song.measures),
+            'chords': sum(1 for c in song.chords()),
+        }
+        for phase, t in best.items():
+            result[phase + '_ms'] = t * 1000
+        results.append(result)
+        if progress:
+            progress(result)
+    import cairo
+    from realbook.score import MusicScore
+    phase_stats = {}
+    for phase in phases:
+        stats = summarize([r[phase + '_ms'] / 1000 for r in results
+            if phase + '_ms' in r])
+        stats['peak_rss_growth_kb'] = rss[phase]
+        phase_stats[phase] = stats
+    return {
+        'version': BENCH_VERSION,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'cairo': getattr(cairo, 'version', None),
+        'glyph_runs': MusicScore.glyph_runs,
+        'corpus': {
+            'songs': count,
+            'measures': measures,
+            'seed': seed,
+            'comment_length': comment_length,
+            'repeat': repeat,
+            'coverage': coverage(parsed),
+        },
+        'phases': phase_stats,
+        'peak_rss_kb': max_rss(),
+        'songs': results,
+    }
+
+def report(results, base=None, out=sys.stdout):
+    """Writes the phase timings, with the ratio to ``base`` if given."""
+    corpus = results['corpus']
+    out.write('%d songs of %d measures, %d/%d chord qualities\n' %(
+        corpus['songs'], corpus['measures'], corpus['coverage']['qualities'],
+        len(chord_table)))
+    for phase in PHASES:
+        stats = results['phases'].get(phase)
+        if not stats:
+            continue
+        line = '%-8s total %9.2f ms  mean %8.3f ms  p95 %8.3f ms' %(phase,
+            stats['total_ms'], stats['mean_ms'], stats['p95_ms'])
+        if base and phase in base.get('phases', {}):
+            old = base['phases'][phase]['mean_ms']
+            line += '  %5.2fx' %(old and stats['mean_ms'] / old or 0)
+        out.write(line + '\n')
+    out.write('peak rss %d kB\n' %results['peak_rss_kb'])
+
+def object_size(obj):
+    """Bytes used by an object, its attribute dictionary, if any, and the
+    floats, lists, dictionaries and Skyline it holds; the objects in its
+    lists, like the Chords of a Measure, are not counted."""
+    size = sys.getsizeof(obj)
+    values = []
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+        values.extend(obj.__dict__.itervalues())
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if hasattr(obj, name):
+                values.append(getattr(obj, name))
+    for value in values:
+        if isinstance(value, Skyline):
+            size += object_size(value)
+        elif isinstance(value, (list, dict)):
+            size += sys.getsizeof(value)
+            if isinstance(value, list):
+                size += sum(sys.getsizeof(v) for v in value
+                    if isinstance(v, float))
+        elif isinstance(value, float):
+            size += sys.getsizeof(value)
+    return size
+
+class _Instance:
+    pass
+
+def instance_size(obj):
+    """object_size of a classic instance holding the attributes of the
+    slots of ``obj`` in its __dict__, like the classes had before their
+    __slots__."""
+    copy = _Instance()
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if hasattr(obj, name):
+                copy.__dict__[name.lstrip('_')] = getattr(obj, name)
+    return object_size(copy)
+
+def bench_memory(staffs=1000, out=sys.stdout):
+    """Reports the bytes used per measure and per chord on a large
+    synthetic book, before and after the measures are laid out, with the
+    __slots__ of the classes and with an attribute dictionary instead.
+
+    The drawing state is kept in the slots of the content objects: the
+    "laid out" figures include it, with the skyline of every measure
+    filled as by a layout.
+    """
+    book = []
+    for i in xrange(staffs):
+        staff = Staff(None, i)
+        for j in xrange(4):
+            m = staff.add_measure(index=j)
+            for k in xrange(4):
+                m.add_chord(k, ('C7', 'F-7', 'Bb^7', 'G7b9/B')[k])
+            m.add_symbol(0, 'segno')
+        book.append(staff)
+    measures = [m for staff in book for m in staff.measures]
+    chords = [c for m in measures for c in m.chords]
+    def report(name):
+        for label, size in (('slots', object_size), ('dict', instance_size)):
+            out.write('%-9s %-5s %7.1f bytes/measure %7.1f bytes/chord\n' %(
+                name, label,
+                sum(size(m) for m in measures) / float(len(measures)),
+                sum(size(c) for c in chords) / float(len(chords))))
+    out.write('%d measures, %d chords\n' %(len(measures), len(chords)))
+    report('content')
+    for m in measures:
+        m.reset_drawing()
+        m.width, m.height = 120.5, 40.5
+        for c in m.chords:
+            c.reset_drawing()
+            c.left, c.top = c.index*30.5, -20.5
+            c.width, c.height = 28.5, 18.5
+            m.skyline.add(c.left, c.width, 20.5)
+        for symbol in m.symbols:
+            m.skyline.add(symbol.index*30.5, 16.5, 40.5)
+    report('laid out')
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--songs', type='int', default=20,
+        help='number of songs [%default]')
+    parser.add_option('-m', '--measures', type='int', default=32,
+        help='measures per song [%default]')
+    parser.add_option('--seed', type='int', default=0,
+        help='seed of the corpus [%default]')
+    parser.add_option('--comment-length', type='int', default=200,
+        help='length of the comments [%default]')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+        help='runs of each song, the best is kept [%default]')
+    parser.add_option('-p', '--phases', default=','.join(PHASES),
+        help='comma separated phases to run [%default]')
+    parser.add_option('--ttf-dir', default=None,
+        help='directory of the Jazz fonts')
+    parser.add_option('--json', default=None,
+        help='write the json results to this file, - for stdout')
+    parser.add_option('--compare', default=None,
+        help='json results of an earlier run to compare with')
+    parser.add_option('--memory', action='store_true', default=False,
+        help='report the bytes used per measure and per chord')
+    options, args = parser.parse_args(argv)
+    if options.memory:
+        bench_memory()
+        return 0
+    phases = [p for p in options.phases.split(',') if p]
+    for phase in phases:
+        if phase not in PHASES:
+            parser.error('unknown phase: %s' %phase)
+    if options.ttf_dir:
+        from realbook.score import preload_fonts
+        preload_fonts(ttf_dir=options.ttf_dir)
+    base = None
+    if options.compare:
+        f = open(options.compare)
+        try:
+            base = json.load(f)
+        finally:
+            f.close()
+        if base.get('version') != BENCH_VERSION:
+            parser.error('%s: results of another benchmark version'
+                %options.compare)
+    results = run(options.songs, options.measures, options.seed,
+        options.comment_length, options.repeat, phases)
+    if options.json == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        report(results, base)
+        if options.json:
+            f = open(options.json, 'w')
+            try:
+                json.dump(results, f, indent=2, sort_keys=True)
+            finally:
+                f.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright (C) 2010 Vittorio Palmisano <vpalmisano at gmail dot com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+"""Renders a whole fake book into a single pdf file.
+
+    python -m parser.book [options] songs.txt book.pdf
+
+The songs are laid out, emitted and released one at a time, so the
+memory used does not grow with the size of the book. Every song gets a
+pdf outline entry and an index with the page numbers is appended at the
+end of the book.
+"""
+import os
+import sys
+import cairo
+import traceback
+from optparse import OptionParser
+
+from realbook.score import MusicScore, font_registry
+from realbook.layout import LayoutCache
+from realbook.transpose import transpose, transpose_key, \
+    transposing_instruments
+from render import page_sizes, decode_song
+from irealbook import parse
+from batch import read_playlist
+from cache import ParseCache
+
+class BookRenderer:
+    index_font_size = 16
+    index_line_height = 22
+
+    def __init__(self, filename, size=None, cache=None):
+        self.width, self.height = size or page_sizes['pdf']
+        self.surface = cairo.PDFSurface(filename, self.width, self.height)
+        self.cr = cairo.Context(self.surface)
+        self.cache = cache
+        # the songs of a book share the layout of their equal measures
+        self.layout_cache = LayoutCache()
+        self.pages = 0
+        self.entries = []
+
+    def add_song(self, s, semitones=0, key=None):
+        """Lays out and emits the pages of a song, an irealbook:// string or
+        a parsed Song, moved up by ``semitones`` or into the key of tonic
+        ``key``; returns its first page.
+
+        The pages are recorded before any is emitted, so a song that
+        fails leaves nothing in the book.
+        """
+        if isinstance(s, basestring):
+            s = parse(decode_song(s), self.cache)
+        if semitones or key:
+            s = transpose(s, semitones, key)
+        score = MusicScore(layout_cache=self.layout_cache)
+        score.load_song(s)
+        pages = score.record_pages(self.width, self.height)
+        first_page = self.pages + 1
+        cr = self.cr
+        for page in pages:
+            cr.set_source_surface(page, 0, 0)
+            cr.paint()
+            cr.show_page()
+            page.finish()
+        self.pages += len(pages)
+        self.entries.append((score.title, first_page))
+        self.add_outline(score.title, first_page)
+        return first_page
+
+    def add_outline(self, title, page):
+        # pdf outlines need cairo >= 1.16
+        if hasattr(self.surface, 'add_outline'):
+            self.surface.add_outline(cairo.PDF_OUTLINE_ROOT, title,
+                'page=%d' %page, 0)
+
+    def draw_index(self):
+        cr = self.cr
+        padding = MusicScore.padding_left
+        top = MusicScore.padding_top
+        cr.set_source_rgb(0, 0, 0)
+        cr.set_font_face(font_registry.get('JazzText'))
+        cr.set_font_size(self.index_font_size)
+        for title, page in sorted(self.entries, key=lambda e: e[0].lower()):
+            if top + self.index_line_height > self.height - padding:
+                cr.show_page()
+                self.pages += 1
+                top = MusicScore.padding_top
+            top += self.index_line_height
+            number = str(page)
+            xbear, ybear, fwidth, fheight, xadv, yadv = cr.text_extents(number)
+            if hasattr(cr, 'tag_begin'):
+                cr.tag_begin(cairo.TAG_LINK, 'page=%d' %page)
+            cr.move_to(padding, top)
+            cr.show_text(title)
+            cr.move_to(self.width - padding - fwidth, top)
+            cr.show_text(number)
+            if hasattr(cr, 'tag_end'):
+                cr.tag_end(cairo.TAG_LINK)
+        cr.show_page()
+        self.pages += 1
+
+    def finish(self, index=True):
+        if index and self.entries:
+            self.draw_index()
+        self.surface.finish()
+
+def book_filename(filename, label):
+    name, ext = os.path.splitext(filename)
+    return '%s [%s]%s' %(name, label, ext)
+
+def render_book(songs, filename, size=None, index=True, progress=None,
+                cache=None, transpositions=None):
+    """Renders the songs into the pdf ``filename``; returns its entries.
+
+    ``transpositions``, a list of (label, semitones) or (label, tonic),
+    renders instead one book per transposition, named after the label,
+    parsing each song once: the songs are moved up by the semitones, or
+    into the key of the tonic. The entries of every book are returned.
+
+    ``progress(index, title, page, error)`` is called for every song of
+    every book. A song that fails is left out of the book: ``page`` is
+    None and ``error`` is its traceback (``title`` too when it could not
+    be parsed).
+    """
+    if transpositions is None:
+        books = [(BookRenderer(filename, size, cache), 0)]
+    else:
+        books = [(BookRenderer(book_filename(filename, label), size, cache),
+            shift) for label, shift in transpositions]
+    for i, s in enumerate(songs):
+        s = decode_song(s)
+        if not s:
+            continue
+        try:
+            song = parse(s, cache)
+        except Exception:
+            if progress:
+                progress(i, None, None, traceback.format_exc())
+            continue
+        for book, shift in books:
+            try:
+                if isinstance(shift, basestring):
+                    page = book.add_song(song, key=shift)
+                else:
+                    page = book.add_song(song, shift)
+            except Exception:
+                if progress:
+                    progress(i, song.title, None, traceback.format_exc())
+                continue
+            if progress:
+                progress(i, book.entries[-1][0], page, None)
+    for book, shift in books:
+        book.finish(index)
+    if transpositions is None:
+        return books[0][0].entries
+    return [book.entries for book, shift in books]
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] songs.txt book.pdf')
+    parser.add_option('--no-index', action='store_false', dest='index',
+        default=True, help='do not append the index of the songs')
+    parser.add_option('--parse-cache', default=None,
+        help='directory of the cache of the parsed songs')
+    parser.add_option('--all-keys', action='store_true', default=False,
+        help='render one book for each of the 12 keys, with all the songs '
+             'in that key')
+    parser.add_option('--instruments', default='',
+        help='render one book for each of these comma separated '
+             'transposing instruments (C, Bb, Eb, F)')
+    parser.add_option('-q', '--quiet', action='store_true', default=False)
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error('a playlist and an output file are required')
+    failures = []
+    def progress(index, title, page, error):
+        if error:
+            failures.append(index)
+            sys.stderr.write('%03d FAILED: %s\n' %(index,
+                error.strip().splitlines()[-1]))
+        elif not options.quiet:
+            sys.stderr.write('%03d %s (page %d)\n' %(index, title, page))
+    transpositions = []
+    if options.all_keys:
+        for i in xrange(12):
+            tonic = transpose_key(('C', 'maj'), i)[0]
+            transpositions.append((tonic, tonic))
+    for instrument in options.instruments.split(','):
+        if not instrument:
+            continue
+        if instrument not in transposing_instruments:
+            parser.error('unknown instrument: %s' %instrument)
+        transpositions.append(('%s instruments' %instrument,
+            transposing_instruments[instrument]))
+    cache = options.parse_cache and ParseCache(options.parse_cache) or None
+    render_book(read_playlist(args[0]), args[1], index=options.index,
+        progress=progress, cache=cache,
+        transpositions=transpositions or None)
+    return failures and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright (C) 2010 Vittorio Palmisano <vpalmisano at gmail dot com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+"""On-disk caches shared by the processes rendering songs.
+
+Every entry is a file named after the sha1 of its key. Entries are
+written to a temporary file and renamed into place, so a reader never
+sees a partial entry; the modification time of an entry is refreshed
+when it is read and the least recently used entries are removed when
+the size of the directory goes over its budget. The eviction holds an
+exclusive lock on a lock file so that a single process at a time scans
+the directory.
+"""
+import os
+import sys
+import fcntl
+import hashlib
+import tempfile
+
+from realbook import model
+from irealbook import IRealBookParser, PARSER_VERSION
+
+class DiskCache:
+    def __init__(self, directory, max_bytes=64*1024*1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        self.lock_path = os.path.join(directory, '.lock')
+        # bytes written by this process since the last eviction scan
+        self.written = 0
+
+    def __repr__(self):
+        return '<DiskCache %s (%d bytes max)>' %(self.directory, self.max_bytes)
+
+    def key(self, *parts):
+        h = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            h.update(str(part))
+            h.update('\0')
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        try:
+            os.utime(path, None)
+        except OSError:
+            # evicted meanwhile
+            pass
+        return data
+
+    def set(self, key, data):
+        path = self.path(key)
+        d = os.path.dirname(path)
+        if not os.path.isdir(d):
+            try:
+                os.mkdir(d)
+            except OSError:
+                if not os.path.isdir(d):
+                    raise
+        fd, tmp = tempfile.mkstemp(prefix='.tmp', dir=d)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmp, path)
+        except:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        self.written += len(data)
+        if self.written > self.max_bytes/16:
+            self.evict()
+
+    def entries(self):
+        entries = []
+        for d in os.listdir(self.directory):
+            d = os.path.join(self.directory, d)
+            if not os.path.isdir(d):
+                continue
+            for name in os.listdir(d):
+                if name.startswith('.tmp'):
+                    continue
+                path = os.path.join(d, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def size(self):
+        return sum(e[1] for e in self.entries())
+
+    def evict(self):
+        """Removes the least recently used entries over the size budget."""
+        self.written = 0
+        lock = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            entries = self.entries()
+            total = sum(e[1] for e in entries)
+            if total <= self.max_bytes:
+                return 0
+            entries.sort()
+            removed = 0
+            # leave some room so that the next writes do not evict again
+            target = self.max_bytes*0.9
+            for mtime, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+            return removed
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+            lock.close()
+
+    def clear(self):
+        for mtime, size, path in self.entries():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+class ParseCache:
+    """Cache of the Songs parsed from irealbook:// strings.
+
+    The key is the sha1 of the song string and of the parser version; on
+    a hit the song is rebuilt from its serialized form and the parser is
+    not run at all.
+    """
+
+    def __init__(self, directory, max_bytes=64*1024*1024):
+        self.store = DiskCache(directory, max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return '<ParseCache %s, %d hits, %d misses>' %(self.store.directory,
+            self.hits, self.misses)
+
+    def key(self, s):
+        return self.store.key(PARSER_VERSION, model.DUMP_VERSION,
+            sys.version_info[:2], s)
+
+    def parse(self, s):
+        s = s.strip()
+        key = self.key(s)
+        data = self.store.get(key)
+        if data is not None:
+            try:
+                song = model.loads(data)
+            except Exception:
+                # corrupted entry, parse again
+                pass
+            else:
+                self.hits += 1
+                return song
+        self.misses += 1
+        song = IRealBookParser(None, s).song
+        self.store.set(key, model.dumps(song))
+        return song
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': total and float(self.hits)/total or 0.0,
+        }
+
+class RenderCache:
+    """Cache of the pdf and png files rendered from irealbook:// strings.
+
+    The key covers the song, the output format, the page size, the dpi,
+    the version of the renderer and the content of the font files, so a
+    hit can be returned without parsing or drawing anything.
+    """
+
+    def __init__(self, directory, max_bytes=256*1024*1024, fonts=None):
+        self.store = DiskCache(directory, max_bytes)
+        self.fonts = fonts
+        self.fonts_hash = None
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.bytes_written = 0
+
+    def __repr__(self):
+        return '<RenderCache %s, %d hits, %d misses>' %(self.store.directory,
+            self.hits, self.misses)
+
+    def font_files_hash(self):
+        if self.fonts_hash is None:
+            if self.fonts is None:
+                from realbook.score import font_registry
+                self.fonts = font_registry
+            h = hashlib.sha1()
+            for name in self.fonts.fonts:
+                f = open(self.fonts.path(name), 'rb')
+                try:
+                    h.update(f.read())
+                finally:
+                    f.close()
+            self.fonts_hash = h.hexdigest()
+        return self.fonts_hash
+
+    def key(self, s, fmt, size, dpi):
+        # render is imported lazily: it needs cairo, the parse cache does not
+        from render import page_sizes, RENDER_VERSION
+        size = tuple(size or page_sizes[fmt])
+        return self.store.key(RENDER_VERSION, s.strip(), fmt, size, dpi,
+            self.font_files_hash())
+
+    def get(self, s, fmt='pdf', size=None, dpi=100):
+        data = self.store.get(self.key(s, fmt, size, dpi))
+        if data is not None:
+            self.hits += 1
+            self.bytes_saved += len(data)
+        return data
+
+    def render(self, s, fmt='pdf', size=None, dpi=100, cache=None):
+        """Returns the rendered song, drawing it only on a miss.
+
+        ``cache`` is the optional ParseCache used on a miss.
+        """
+        key = self.key(s, fmt, size, dpi)
+        data = self.store.get(key)
+        if data is not None:
+            self.hits += 1
+            self.bytes_saved += len(data)
+            return data
+        from render import render_bytes
+        self.misses += 1
+        data = render_bytes(s, fmt, size, dpi, cache)
+        self.store.set(key, data)
+        self.bytes_written += len(data)
+        return data
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': total and float(self.hits)/total or 0.0,
+            'bytes_saved': self.bytes_saved,
+            'bytes_written': self.bytes_written,
+        }
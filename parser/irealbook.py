@@ -20,103 +20,116 @@
 import os
 import sys
 import re
-import cairo
-import math
+import time
+import urllib
+
+from realbook.model import Song
+from realbook.transpose import parse_key
+from tokenizer import tokenize
+
+SONG_RE = r"irealbook://(?P<title>[\w\s\-\ ',\(\)?]+)=(?P<author>[\w\s\-\ ',]+)=(?P<tempo>[\w\s\-\ ',]+)=(?P<key>[\w\s#-]+)=(.)=(?P<song>.+Z)"
+song_re = re.compile(SONG_RE)
 
-from realbook.score import MusicScore
+# to be increased whenever the songs produced by the parser change, it
+# invalidates the cached songs
+PARSER_VERSION = 4
+
+BARLINES = ('|', '{', '[', '}', ']')
 
-SONG_RE = r"irealbook://(?P<title>[\w\s\-\ ',\(\)?]+)=(?P<author>[\w\s\-\ ',]+)=(?P<tempo>[\w\s\-\ ',]+)=(?P<key>[\w\s-]+)=(.)=(?P<song>.+Z)"
-    
 class IRealBookParser:
-    def __init__(self, score, s):
+    """Parses an irealbook:// string into a Song.
+
+    When a MusicScore is given, the song is also loaded into it. ``stats``
+    is an optional realbook.stats.RenderStats, by default the one of the
+    score.
+    """
+    def __init__(self, score, s, stats=None):
+        self.score = score
+        self.song = Song()
+        if stats is None and score is not None:
+            stats = score.stats
+        if stats is not None:
+            t = time.time()
         s = s.strip()
         if not s:
             return
-        self.score = score
-        song_re = re.compile(SONG_RE)
-        m = re.search(song_re, s)
-        print s
+        m = song_re.search(s)
+        if m is None:
+            raise ValueError('not an irealbook song: %r' %s[:80])
         d = m.groupdict()
-        self.score.title = d['title']
-        self.score.author = d['author']
-        self.score.tempo = d['tempo']
+        self.parse(d)
+        if stats is not None:
+            stats.add('parse', time.time() - t)
+            stats.add_song(self.song)
+        if score is not None:
+            score.load_song(self.song)
+
+    def parse(self, d):
+        s = self.song
+        s.title = d['title']
+        s.author = d['author']
+        s.tempo = d['tempo']
+        s.key = d['key']
         #
-        chord_list = ('A', 'B', 'C', 'D', 'E', 'F', 'G')
         song = d['song']
-        s = self.score.add_staff()
         measure, chord, chord_index = None, None, 0
         prev_measure = None
         next_chord_lower = False
         next_chord_fermata = False
+        next_chord_alternate = False
         measure_count = 0
-        i = 0
-        while i < len(song):
-            if song[i] in ('|', '{', '[', '}', ']'):
+        for kind, value, i in tokenize(song):
+            prev = i and song[i-1] or ''
+            if kind == 'barline':
                 if measure:
                     if measure_count == 4:
-                        s = self.score.add_staff()
+                        s.new_line()
                         measure_count = 0  
-                    if song[i] == '}':
+                    if value == '}':
                         measure.stop_barline = 'repeat'
-                    elif song[i] == ']':
+                    elif value == ']':
                         measure.stop_barline = 'double'
-                if song[i-1] in ('|', '{', '[', '}', ']', 'Y'):
-                    if song[i] == '{':
+                if prev in BARLINES or prev == 'Y':
+                    if value == '{':
                         measure.start_barline = 'repeat'
-                    elif song[i] == '[' and song[i-1] != ']':
+                    elif value == '[' and prev != ']':
                         measure.start_barline = 'double'
                         prev_measure.stop_barline = 'single'
-                    i += 1
                     continue
                 # new measure
                 prev_measure = measure
                 measure = s.add_measure(start_barline='single', empty=True)
-                if measure_count == 0 and s.index == 0:
-                    key, mode = d['key'][0], 'maj'
-                    if len(d['key']) == 2:
-                        if d['key'][1] in ('b', '#'):
-                            key += d['key'][1]
-                        elif d['key'][1] == 'm':
-                            mode = 'min'
-                    elif len(d['key']) == 3:
-                        if d['key'][1] in ('b', '#'):
-                            key += d['key'][1]
-                        if d['key'][2] == 'm':
-                            mode = 'min'
-                    measure.key_signature = (key, mode)
+                if measure_count == 0 and s.line == 0:
+                    measure.key_signature = self.key_signature(d['key'])
                 measure_count += 1
                 chord = None
                 chord_index = 0
-                if song[i] == '{':
+                if value == '{':
                     measure.start_barline='repeat'
                     measure.empty = False
-                elif song[i] == '[' and song[i-1] != ']':
+                elif value == '[' and prev != ']':
                     prev_measure.stop_barline = 'single'
                     measure.start_barline='double'
                     measure.empty = False
-            elif song[i] == '*':
-                if song[i+1] in ('A', 'B', 'C', 'D', 'i'):
-                    if song[i+1] == 'i':
-                        measure.section = 'intro'
-                    else:
-                        measure.section = song[i+1]
-                    i += 1
+            elif kind == 'section':
+                if value == 'i':
+                    measure.section = 'intro'
                 else:
-                    j = song[i:].find('*')
-                    chord.chord += song[i+1:j]
-                    i += j
-            elif song[i] == 'T':
+                    measure.section = value
+            elif kind == 'time':
                 try:
-                    measure.time = (int(song[i+1]), int(song[i+2]))
-                except Exception, e:
-                    print song[i:i+3]
-                    raise Exception(e)
-                i += 2
-            elif song[i] in chord_list:
-                if chord and song[i-1] == '/':
-                    chord.chord += song[i]
+                    measure.time = (int(value[0]), int(value[1]))
+                except ValueError:
+                    raise ValueError('invalid time signature: T%s' %value)
+            elif kind == 'chord':
+                if chord and prev == '/':
+                    chord.chord += value
+                elif next_chord_alternate:
+                    chord = measure.add_chord(chord_index-1, value, alternate=True)
+                    measure.empty = False
+                    next_chord_alternate = False
                 else:
-                    chord = measure.add_chord(chord_index, song[i])
+                    chord = measure.add_chord(chord_index, value)
                     measure.empty = False
                     if next_chord_lower:
                         chord.small = True
@@ -125,30 +138,26 @@ class IRealBookParser:
                         chord.fermata = True
                         next_chord_fermata = False
                     chord_index += 1
-            elif song[i] == ' ':
-                if chord_index == 4:
-                    prev_measure = measure
-                    measure = s.add_measure(empty=True)
-                    measure_count += 1
-                    chord_index = 0
-                measure.add_chord(chord_index, '')
-                chord_index += 1
-            elif song[i] == ',':
+            elif kind == 'space':
+                for j in xrange(value):
+                    if chord_index == 4:
+                        prev_measure = measure
+                        measure = s.add_measure(empty=True)
+                        measure_count += 1
+                        chord_index = 0
+                    measure.add_chord(chord_index, '')
+                    chord_index += 1
+            elif kind == 'comma':
                 chord = None
-            elif song[i] == 'N':
-                measure.ending = song[i+1]
-                i += 1
-            elif song[i] == 's' and song[i:i+3] != 'sus' and song[i-2:i+1] != 'sus':
+            elif kind == 'ending':
+                measure.ending = value
+            elif kind == 'small':
                 next_chord_lower = True
-            elif song[i] == 'l' and song[i+1] in chord_list:
+            elif kind == 'large':
                 next_chord_lower = False
-            elif song[i] in ('Z', '='):
+            elif kind == 'final':
                 measure.stop_barline = 'final'
-                break
-            elif song[i] in ('Y', 'p'):
-                #TODO
-                pass
-            elif song[i] in ('%', 'x', 'r', 'n'):
+            elif kind == 'repeat':
                 if chord_index == 4:
                     prev_measure = measure
                     measure = s.add_measure(empty=True)
@@ -157,38 +166,58 @@ class IRealBookParser:
                 measure.add_symbol(chord_index, '%') #TODO
                 measure.empty = False
                 chord_index += 1
-                if song[i] == 'r':
+                if value == 'r':
                     prev_measure = measure
                     measure = s.add_measure(empty=False)
                     measure_count += 1
                     chord_index = 0
-                    j = song[i+2:].find('|')
-                    i += j
-            elif song[i] == '(':
-                chord = measure.add_chord(chord_index-1, song[i+1], alternate=True)
-                measure.empty = False
-                i += 1
-            elif song[i] == ')':
+            elif kind == 'alternate':
+                next_chord_alternate = True
+            elif kind == 'close':
                 chord = None
-            elif song[i] == '<':
-                j = song[i:].find('>')
-                text = song[i+1:i+j]
-                i += j
-                measure.add_symbol(chord_index, text)
-            elif song[i] == 'S':
-                measure.add_symbol(chord_index, 'segno')
-            elif song[i] == 'Q':
+                next_chord_alternate = False
+            elif kind == 'comment':
+                measure.add_symbol(chord_index, value)
+            elif kind in ('segno', 'coda'):
                 measure.add_symbol(chord_index, 'segno')
-            elif song[i] == 'f':
+            elif kind == 'fermata':
                 next_chord_fermata = True
-            else:
-                try:
-                    chord.chord += song[i]
-                except Exception, e:
-                    print i, song, '\nError:', song[i:], '\n'
-            i += 1
+            elif kind == 'text':
+                if chord:
+                    chord.chord += value
+        s.normalize()
+        return s
+
+    def key_signature(self, key):
+        return parse_key(key)
         
+def decode_song(s):
+    """Returns the irealbook:// string with its url quoting removed."""
+    s = s.strip()
+    # the fields of a quoted song are separated by %3D
+    if '=' not in s:
+        s = urllib.unquote(s)
+    return s
+
+def parse(s, cache=None, stats=None):
+    """Returns the Song of an irealbook:// string, without using cairo.
+
+    ``cache`` is an optional parser.cache.ParseCache and ``stats`` an
+    optional realbook.stats.RenderStats.
+    """
+    if cache is None:
+        return IRealBookParser(None, s, stats).song
+    if stats is None:
+        return cache.parse(s)
+    t = time.time()
+    song = cache.parse(s)
+    stats.add('parse', time.time() - t)
+    stats.add_song(song)
+    return song
+
 def test(i, s):
+    import cairo
+    from realbook.score import MusicScore
     score = MusicScore()
     IRealBookParser(score, s)
     #
@@ -201,6 +230,8 @@ def test(i, s):
     cr.show_page()
    
 def test1(s):
+    import cairo
+    from realbook.score import MusicScore
     score = MusicScore()
     IRealBookParser(score, s)
     # write to png
@@ -222,5 +253,5 @@ if __name__ == '__main__':
 
     songs = open('songs.txt').read().split('\n')
     start = int(sys.argv[1])
-    for s in songs[start:]:
-        test(songs.index(s), s)
+    for i in xrange(start, len(songs)):
+        test(i, songs[i])
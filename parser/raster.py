@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright (C) 2010 Vittorio Palmisano <vpalmisano at gmail dot com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+"""Raster rendering of a score in horizontal bands.
+
+A page at 600 dpi is tens of millions of pixels: instead of drawing it
+on one image surface, the layout of the score is drawn band after band
+on a surface of ``band_height`` rows, and every band is passed to a
+callback or appended to a png file as it is drawn.
+"""
+import sys
+import math
+import zlib
+import struct
+import cairo
+
+from realbook.layout import LayoutNode
+
+class PNGWriter:
+    """Writes an opaque RGB png to ``f`` a band of rows at a time.
+
+    The rows come from a cairo ARGB32 surface; the alpha channel is
+    dropped, the pages of the scores having a white background.
+    """
+
+    def __init__(self, f, width, height, level=6):
+        self.f = f
+        self.width, self.height = width, height
+        self.rows = 0
+        self.compressor = zlib.compressobj(level)
+        f.write('\x89PNG\r\n\x1a\n')
+        # 8 bits RGB, no interlace
+        self.chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0,
+            0, 0))
+        if sys.byteorder == 'little':
+            self.channels = (2, 1, 0)
+        else:
+            self.channels = (1, 2, 3)
+
+    def chunk(self, kind, data):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(kind)
+        self.f.write(data)
+        self.f.write(struct.pack('>I',
+            zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff))
+
+    def write_rows(self, data, stride, rows):
+        """Appends ``rows`` rows of ARGB32 pixels of ``data``, a string or
+        buffer of ``stride`` bytes per row."""
+        width = self.width
+        r, g, b = self.channels
+        out = []
+        for i in xrange(rows):
+            row = data[i*stride:i*stride + width*4]
+            rgb = bytearray(width*3)
+            rgb[0::3] = row[r::4]
+            rgb[1::3] = row[g::4]
+            rgb[2::3] = row[b::4]
+            # filter type none
+            out.append('\x00')
+            out.append(str(rgb))
+        data = self.compressor.compress(''.join(out))
+        if data:
+            self.chunk('IDAT', data)
+        self.rows += rows
+
+    def close(self):
+        if self.rows != self.height:
+            raise ValueError('%d rows written of %d' %(self.rows, self.height))
+        self.chunk('IDAT', self.compressor.flush())
+        self.chunk('IEND', '')
+
+def band_layout(layout, top, bottom, margin):
+    """A copy of the root of ``layout`` keeping only the nodes whose box
+    is within ``margin`` of [top, bottom]."""
+    band = LayoutNode(layout.kind, layout.obj)
+    for op in layout.ops:
+        if isinstance(op, LayoutNode):
+            if op.y + op.height + margin < top or op.y - margin > bottom:
+                continue
+            band.add(op)
+        else:
+            band.ops.append(op)
+    return band
+
+def render_tiled(score, width, height, dpi=600, callback=None, f=None,
+                 band_height=256):
+    """Draws the score in bands of ``band_height`` rows at ``dpi``.
+
+    ``width`` and ``height`` are the size of the page at 100 dpi, like
+    the png page size. The score is laid out once; every band is passed
+    to ``callback(y, rows, data, stride)``, with the ARGB32 pixels of the
+    ``rows`` rows starting at the row ``y``, or written as a png to the
+    file object ``f``. Returns the width and height of the image in
+    pixels.
+    """
+    scale = dpi / 100.0
+    w, h = int(math.ceil(width*scale)), int(math.ceil(height*scale))
+    layout = score.layout(width, height, dpi)
+    if callback is None:
+        writer = PNGWriter(f, w, h)
+        callback = lambda y, rows, data, stride: writer.write_rows(data,
+            stride, rows)
+    else:
+        writer = None
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, min(band_height, h))
+    stride = surface.get_stride()
+    for y in xrange(0, h, band_height):
+        rows = min(band_height, h - y)
+        cr = cairo.Context(surface)
+        cr.translate(0, -y)
+        cr.scale(scale, scale)
+        # the nodes outside of the band are not drawn
+        score.render(band_layout(layout, y/scale, (y + rows)/scale,
+            score.padding_top), cr)
+        surface.flush()
+        callback(y, rows, surface.get_data(), stride)
+    surface.finish()
+    if writer is not None:
+        writer.close()
+    return w, h
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright (C) 2010 Vittorio Palmisano <vpalmisano at gmail dot com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+import os
+import math
+import time
+import cairo
+from cStringIO import StringIO
+
+from realbook.score import MusicScore
+from realbook.layout import LayoutCache
+from realbook.transpose import transpositions
+from irealbook import parse, song_re, decode_song
+from raster import render_tiled
+
+# to be increased whenever the files drawn for a song change, it
+# invalidates the files of the render cache: 2 for the skyline placement
+# of the symbols, 3 for the pages of the long scores, 4 for the banded
+# png output at high dpi, 5 for the png output below 100 dpi
+RENDER_VERSION = 5
+
+# width, height in points for the pdf output and pixels for the png one
+page_sizes = {
+    'pdf': (8.27*100, 11.69*100),
+    'png': (800, 1200),
+    'svg': (8.27*100, 11.69*100),
+}
+
+def song_title(s):
+    m = song_re.search(s)
+    if m is None:
+        raise ValueError('not an irealbook song: %r' %s[:80])
+    return m.group('title')
+
+def song_filename(index, title, fmt='pdf'):
+    title = title.replace(os.sep, '-')
+    return '%03d - %s.%s' %(index, title, fmt)
+
+def parse_song(s, cache=None, stats=None, layout_cache=None):
+    score = MusicScore(stats=stats, layout_cache=layout_cache)
+    score.load_song(parse(decode_song(s), cache, stats))
+    return score
+
+def render_score(score, f, fmt='pdf', size=None, dpi=100):
+    """Renders the score into ``f``, a file name or a file object.
+
+    When the score has a RenderStats, the writing of the surface is timed
+    and the stats are finished once the file is written.
+    """
+    w, h = size or page_sizes[fmt]
+    stats = score.stats
+    if fmt == 'pdf':
+        # the long scores continue on the next pages
+        surface = cairo.PDFSurface(f, w, h)
+        cr = cairo.Context(surface)
+        score.draw_pages(cr, w, h, dpi)
+        if stats is not None:
+            t = time.time()
+        surface.finish()
+    elif fmt == 'png' and dpi > 100:
+        # the page size is in pixels at 100 dpi, the high resolution
+        # images are drawn in bands
+        if isinstance(f, basestring):
+            f = open(f, 'wb')
+            try:
+                render_tiled(score, w, h, dpi, f=f)
+            finally:
+                f.close()
+        else:
+            render_tiled(score, w, h, dpi, f=f)
+        if stats is not None:
+            t = time.time()
+    elif fmt == 'png':
+        scale = dpi / 100.0
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+            int(math.ceil(w*scale)), int(math.ceil(h*scale)))
+        cr = cairo.Context(surface)
+        cr.scale(scale, scale)
+        score.draw(cr, w, h, dpi)
+        if stats is not None:
+            t = time.time()
+        surface.write_to_png(f)
+    elif fmt == 'svg':
+        surface = cairo.SVGSurface(f, w, h)
+        cr = cairo.Context(surface)
+        score.draw(cr, w, h, dpi)
+        if stats is not None:
+            t = time.time()
+        cr.show_page()
+        surface.finish()
+    else:
+        raise ValueError('unknown output format: %s' %fmt)
+    if stats is not None:
+        stats.add('write', time.time() - t)
+        stats.finish()
+
+def replay(recording, f, fmt, width, height, scale=1.0):
+    """Paints a score recorded by MusicScore.record into ``f``, a file
+    name or a file object, in the pdf, png or svg format.
+
+    ``recording`` can also be the list of the pages recorded by
+    MusicScore.record_pages, for a pdf. ``width`` and ``height`` are
+    those of the recording; the output is ``scale`` times larger, a png
+    of scale 2 has twice the pixels.
+    """
+    if not isinstance(recording, list):
+        recording = [recording]
+    if fmt != 'pdf' and len(recording) != 1:
+        raise ValueError('a %s file has a single page' %fmt)
+    w, h = width*scale, height*scale
+    if fmt == 'pdf':
+        surface = cairo.PDFSurface(f, w, h)
+    elif fmt == 'svg':
+        surface = cairo.SVGSurface(f, w, h)
+    elif fmt == 'png':
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(math.ceil(w)),
+            int(math.ceil(h)))
+    else:
+        raise ValueError('unknown output format: %s' %fmt)
+    cr = cairo.Context(surface)
+    cr.scale(scale, scale)
+    for page in recording:
+        cr.set_source_surface(page, 0, 0)
+        cr.paint()
+        if fmt != 'png':
+            cr.show_page()
+    if fmt == 'png':
+        surface.write_to_png(f)
+    else:
+        surface.finish()
+
+def render_outputs(score, outputs, size=None, dpi=100):
+    """Draws the score once and replays it into each of ``outputs``.
+
+    ``outputs`` is a list of (f, fmt, scale) tuples, see replay(). All
+    the outputs share the layout of the page ``size``, by default the
+    pdf one. Like render_score, the pdf outputs have all the pages of
+    the score and the others a single page; a score longer than a page
+    is drawn a second time for them.
+    """
+    w, h = size or page_sizes['pdf']
+    pages = score.record_pages(w, h, dpi)
+    recording = None
+    for f, fmt, scale in outputs:
+        if fmt == 'pdf':
+            replay(pages, f, fmt, w, h, scale)
+            continue
+        if recording is None:
+            if len(pages) == 1:
+                recording = pages[0]
+            else:
+                recording = score.record(w, h, dpi)
+        replay(recording, f, fmt, w, h, scale)
+    for page in pages:
+        page.finish()
+    if recording is not None and recording not in pages:
+        recording.finish()
+
+def render_bytes(s, fmt='pdf', size=None, dpi=100, cache=None, stats=None):
+    """Returns the pdf or png data of an irealbook:// string.
+
+    ``stats`` is an optional realbook.stats.RenderStats.
+    """
+    f = StringIO()
+    render_score(parse_song(s, cache, stats), f, fmt, size, dpi)
+    return f.getvalue()
+
+def render_song(s, outdir='.', index=0, fmt='pdf', size=None, cache=None,
+                render_cache=None, dpi=100):
+    """Parses an irealbook:// string and renders it into ``outdir``.
+
+    ``cache`` is an optional parser.cache.ParseCache and ``render_cache``
+    an optional parser.cache.RenderCache. Returns the name of the written
+    file.
+    """
+    s = decode_song(s)
+    filename = os.path.join(outdir, song_filename(index, song_title(s), fmt))
+    if render_cache is not None:
+        data = render_cache.render(s, fmt, size, dpi, cache)
+        f = open(filename, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+    else:
+        render_score(parse_song(s, cache), filename, fmt, size, dpi)
+    return filename
+
+def render_song_formats(s, outdir='.', index=0, formats=('pdf', 'png', 'svg'),
+                        size=None, cache=None, scale=1.0):
+    """Renders an irealbook:// string once into several formats.
+
+    The score is laid out and drawn a single time, a second one for the
+    png and svg of a score longer than a page, see render_outputs(); the
+    png is ``scale`` times larger than the page. Returns the names of
+    the written files.
+    """
+    s = decode_song(s)
+    title = song_title(s)
+    filenames = [os.path.join(outdir, song_filename(index, title, fmt))
+        for fmt in formats]
+    outputs = [(filename, fmt, fmt == 'png' and scale or 1.0)
+        for filename, fmt in zip(filenames, formats)]
+    render_outputs(parse_song(s, cache), outputs, size)
+    return filenames
+
+def render_song_keys(s, outdir='.', index=0, keys=(), instruments=(),
+                     formats=('pdf',), size=None, cache=None, dpi=100):
+    """Parses an irealbook:// string once and renders it in several keys.
+
+    ``keys`` and ``instruments`` are those of
+    realbook.transpose.transpositions; the files are named after the
+    song and the key. The transposed scores share the layout of their
+    equal measures. With several formats, the png is replayed at
+    ``dpi``, see render_song_formats. Returns the names of the written
+    files.
+    """
+    song = parse(decode_song(s), cache)
+    layout_cache = LayoutCache()
+    filenames = []
+    for label, transposed in transpositions(song, keys, instruments):
+        score = MusicScore(layout_cache=layout_cache)
+        score.load_song(transposed)
+        title = '%s [%s]' %(song.title, label)
+        outputs = [(os.path.join(outdir, song_filename(index, title, fmt)),
+            fmt, fmt == 'png' and dpi / 100.0 or 1.0) for fmt in formats]
+        if len(outputs) == 1:
+            render_score(score, outputs[0][0], formats[0], size, dpi)
+        else:
+            render_outputs(score, outputs, size)
+        filenames.extend(output[0] for output in outputs)
+    return filenames
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright (C) 2010 Vittorio Palmisano <vpalmisano at gmail dot com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+"""Search of chord progressions in a corpus of irealbook:// songs.
+
+    python -m parser.search index.db add songs.txt
+    python -m parser.search index.db find 'II- V7 I^'
+    python -m parser.search index.db find 'Bb^7 Bb-7 Eb7'
+
+The chords of every song are reduced to tokens relative to the key of
+the song: the degree of the root, as a roman numeral over the major
+scale, followed by the family of the quality:
+
+    ^  major        -  minor        7  dominant     s  suspended
+    h  half dim.    o  diminished   +  augmented
+
+so that Bb-7 Eb7 Ab^7 in Ab is II- V7 I^, and a ii-V-I into the relative
+minor of a major key is VIIh III7 VI-. Repeated chords count once. The
+sequences of 2 and 3 tokens of the songs are kept in an sqlite inverted
+index; a query looks up the songs of its rarest sequence and checks the
+whole progression on their tokens. A query made of chords, like
+Bb^7 Bb-7 Eb7, finds the songs where those chords occur, in any key.
+"""
+import re
+import sys
+import time
+import hashlib
+import sqlite3
+from optparse import OptionParser
+
+from realbook.chord import ChordError, parse_chord
+from realbook.transpose import pitch, parse_key
+from irealbook import parse, decode_song
+
+# version of the tokens and of the tables, an index of another version
+# is rebuilt
+INDEX_VERSION = 1
+
+degrees = ('I', 'bII', 'II', 'bIII', 'III', 'IV', '#IV', 'V', 'bVI', 'VI',
+    'bVII', 'VII')
+
+# qualities of chord.chord_table not classified by their first characters
+quality_families = {
+    '': '^', '2': '^', '5': '^', '6': '^', '69': '^', 'add9': '^',
+    'Maj7': '^', '7+': '^',
+    '^7#5': '+',
+    '-7b5': 'h', 'm': '-',
+}
+
+token_re = re.compile(r'^(b|#)?(VII|VI|V|IV|III|II|I)([-^7sho+])$')
+separator_re = re.compile(ur'\s*(?:,|->|→|\s)\s*', re.UNICODE)
+
+def family(quality):
+    """The family of a chord quality, see the module documentation."""
+    f = quality_families.get(quality)
+    if f is not None:
+        return f
+    if 'sus' in quality:
+        return 's'
+    if quality[0] in '-^+ho':
+        return quality[0]
+    if quality[0] == '0':
+        return 'h'
+    return '7'
+
+def chord_token(symbol):
+    """The (pitch class, family) of a ChordSymbol, its bass dropped."""
+    return (pitch(symbol.root + symbol.accidental), family(symbol.quality))
+
+def song_tokens(song):
+    """The key relative tokens of the chords of a Song."""
+    tonic = pitch(parse_key(song.key or 'C')[0])
+    tokens = []
+    for m, c in song.chords():
+        if c.alternate:
+            continue
+        root, f = chord_token(c.symbol or c.normalize())
+        token = degrees[(root - tonic) % 12] + f
+        if not tokens or tokens[-1] != token:
+            tokens.append(token)
+    return tonic, tokens
+
+def grams(tokens, sizes=(2, 3)):
+    """The distinct sequences of ``sizes`` tokens."""
+    found = set()
+    for n in sizes:
+        for i in xrange(len(tokens) - n + 1):
+            found.add(' '.join(tokens[i:i+n]))
+    return found
+
+def parse_query(query):
+    """Returns the tokens of a query and whether it is made of chords.
+
+    The tokens or chords are separated by spaces, commas or arrows; like
+    in the songs, a repeated one counts once. A query of a single token
+    or chord is valid, it is looked up in the tokens of every song.
+    Raises ValueError for an empty, invalid or mixed query.
+    """
+    if isinstance(query, str):
+        query = query.decode('utf-8')
+    words = [w for w in separator_re.split(query.strip()) if w]
+    if not words:
+        raise ValueError('empty query')
+    chords = not all(token_re.match(w) for w in words)
+    tokens = []
+    for w in words:
+        if chords:
+            try:
+                token = chord_token(parse_chord(str(w)))
+            except (ChordError, UnicodeError):
+                raise ValueError('neither a chord nor a degree: %r' %w)
+        else:
+            token = str(w)
+        if not tokens or tokens[-1] != token:
+            tokens.append(token)
+    return tokens, chords
+
+class ProgressionIndex:
+    """Inverted index of the chord progressions of songs in the sqlite
+    database ``filename``.
+
+    Songs are added incrementally, each once (they are identified by the
+    sha1 of their irealbook:// string); add_songs() commits once for a
+    batch of songs.
+    """
+    sizes = (2, 3)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.text_factory = str
+        self.create()
+
+    def __repr__(self):
+        return '<ProgressionIndex %s (%d songs)>' %(self.filename, len(self))
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+
+    def create(self):
+        db = self.db
+        db.execute('CREATE TABLE IF NOT EXISTS meta '
+            '(name TEXT PRIMARY KEY, value TEXT)')
+        row = db.execute("SELECT value FROM meta WHERE name = 'version'"
+            ).fetchone()
+        if row is not None and int(row[0]) != INDEX_VERSION:
+            for table in ('songs', 'postings', 'grams'):
+                db.execute('DROP TABLE IF EXISTS %s' %table)
+        db.execute('CREATE TABLE IF NOT EXISTS songs (id INTEGER PRIMARY KEY, '
+            'digest TEXT UNIQUE, title TEXT, author TEXT, key TEXT, '
+            'tonic INTEGER, tokens TEXT)')
+        db.execute('CREATE TABLE IF NOT EXISTS postings '
+            '(gram TEXT, song INTEGER, PRIMARY KEY (gram, song))')
+        db.execute('CREATE INDEX IF NOT EXISTS postings_song '
+            'ON postings (song)')
+        db.execute('CREATE TABLE IF NOT EXISTS grams '
+            '(gram TEXT PRIMARY KEY, songs INTEGER)')
+        db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+            (str(INDEX_VERSION),))
+        db.commit()
+
+    def add_song(self, s, commit=True):
+        """Indexes an irealbook:// string; returns the id of the song.
+
+        Raises ValueError (or chord.ChordError) for invalid songs.
+        """
+        s = decode_song(s)
+        digest = hashlib.sha1(s).hexdigest()
+        db = self.db
+        row = db.execute('SELECT id FROM songs WHERE digest = ?',
+            (digest,)).fetchone()
+        if row is not None:
+            return row[0]
+        song = parse(s)
+        tonic, tokens = song_tokens(song)
+        song_id = db.execute('INSERT INTO songs (digest, title, author, key, '
+            'tonic, tokens) VALUES (?, ?, ?, ?, ?, ?)', (digest, song.title,
+            song.author, song.key, tonic, ' '.join(tokens))).lastrowid
+        found = [(gram,) for gram in grams(tokens, self.sizes)]
+        db.executemany('INSERT INTO postings VALUES (?, %d)' %song_id, found)
+        db.executemany('INSERT OR IGNORE INTO grams VALUES (?, 0)', found)
+        db.executemany('UPDATE grams SET songs = songs + 1 WHERE gram = ?',
+            found)
+        if commit:
+            db.commit()
+        return song_id
+
+    def add_songs(self, songs):
+        """Indexes the songs; returns the ids of the indexed ones and the
+        (position, error) of the invalid ones, which do not stop the
+        others."""
+        ids, errors = [], []
+        try:
+            for i, s in enumerate(songs):
+                if not s.strip():
+                    continue
+                try:
+                    ids.append(self.add_song(s, False))
+                except Exception, e:
+                    errors.append((i, '%s: %s' %(e.__class__.__name__, e)))
+        finally:
+            self.db.commit()
+        return ids, errors
+
+    def remove_song(self, song_id):
+        db = self.db
+        found = db.execute('SELECT gram FROM postings WHERE song = ?',
+            (song_id,)).fetchall()
+        db.executemany('UPDATE grams SET songs = songs - 1 WHERE gram = ?',
+            found)
+        db.execute('DELETE FROM grams WHERE songs <= 0')
+        db.execute('DELETE FROM postings WHERE song = ?', (song_id,))
+        db.execute('DELETE FROM songs WHERE id = ?', (song_id,))
+        db.commit()
+
+    def find_tokens(self, tokens, tonic=None):
+        """The (id, title, key) of the songs holding the progression of
+        ``tokens``, of the tonic pitch class ``tonic`` when given."""
+        db = self.db
+        where, args = '', []
+        if tonic is not None:
+            where, args = ' AND s.tonic = ?', [tonic]
+        n = min(len(tokens), max(self.sizes))
+        if n in self.sizes:
+            keys = list(grams(tokens, (n,)))
+            rows = db.execute('SELECT gram, songs FROM grams WHERE gram IN '
+                '(%s)' %','.join('?'*len(keys)), keys).fetchall()
+            if len(rows) < len(keys):
+                # a sequence found in no song
+                return []
+            rarest = min(rows, key=lambda row: row[1])[0]
+            rows = db.execute('SELECT s.id, s.title, s.key, s.tokens '
+                'FROM postings p JOIN songs s ON s.id = p.song '
+                'WHERE p.gram = ?' + where, [rarest] + args)
+        else:
+            rows = db.execute('SELECT s.id, s.title, s.key, s.tokens '
+                'FROM songs s WHERE 1' + where, args)
+        progression = ' %s ' %' '.join(tokens)
+        return [(song_id, title, key)
+            for song_id, title, key, song_tokens in rows
+            if progression in ' %s ' %song_tokens]
+
+    def find(self, query, limit=None):
+        """The (id, title, key) of the songs holding the progression of
+        ``query`` (see parse_query), sorted by title."""
+        tokens, chords = parse_query(query)
+        if chords:
+            found = []
+            for tonic in xrange(12):
+                found.extend(self.find_tokens([degrees[(p - tonic) % 12] + f
+                    for p, f in tokens], tonic))
+        else:
+            found = self.find_tokens(tokens)
+        found.sort(key=lambda song: (song[1].lower(), song[0]))
+        return limit and found[:limit] or found
+
+    def stats(self):
+        db = self.db
+        return {
+            'songs': len(self),
+            'grams': db.execute('SELECT COUNT(*) FROM grams').fetchone()[0],
+            'postings': db.execute('SELECT COUNT(*) FROM postings'
+                ).fetchone()[0],
+        }
+
+    def close(self):
+        self.db.close()
+
+def bench(songs=50000, queries=('II- V7 I^', 'VIIh III7 VI-', 'I^ VI7',
+          'Bb^7 Bb-7 Eb7', 'IV^'), filename=':memory:', out=sys.stdout):
+    """Indexes a synthetic corpus and times the queries on it."""
+    from bench import Corpus
+    index = ProgressionIndex(filename)
+    t = time.time()
+    index.add_songs(Corpus().songs(songs))
+    out.write('%d songs indexed in %.2fs, %r\n' %(len(index), time.time() - t,
+        index.stats()))
+    for query in queries:
+        t = time.time()
+        found = index.find(query)
+        out.write('%-16s %6d songs %8.2f ms\n' %(query, len(found),
+            (time.time() - t)*1000))
+    index.close()
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] index.db add songs.txt\n'
+        '       %prog [options] index.db find progression')
+    parser.add_option('-n', '--limit', type='int', default=None,
+        help='number of songs to list')
+    options, args = parser.parse_args(argv)
+    if len(args) != 3 or args[1] not in ('add', 'find'):
+        parser.error('an index, a command and its argument are required')
+    index = ProgressionIndex(args[0])
+    try:
+        if args[1] == 'add':
+            f = open(args[2])
+            try:
+                ids, errors = index.add_songs(f.read().split('\n'))
+            finally:
+                f.close()
+            for i, error in errors:
+                sys.stderr.write('song %d not indexed: %s\n' %(i, error))
+            sys.stderr.write('%d songs added, %d in the index\n' %(len(ids),
+                len(index)))
+        else:
+            try:
+                found = index.find(args[2], options.limit)
+            except ValueError, e:
+                parser.error(str(e))
+            for song_id, title, key in found:
+                print '%s (%s)' %(title, key)
+    finally:
+        index.close()
+
+if __name__ == '__main__':
+    main()
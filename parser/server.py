@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright (C) 2010 Vittorio Palmisano <vpalmisano at gmail dot com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+"""Local render server of irealbook:// songs.
+
+    python -m parser.server [options]
+
+The songs are rendered by a pool of worker processes that load the
+fonts once and keep the text metrics and the measure layouts of the
+songs they render. The server speaks HTTP over TCP or a Unix socket:
+
+    POST /render?format=png     the body is the irealbook:// string
+    GET  /render?song=...&format=pdf
+    GET  /stats                 json latency and throughput stats
+
+The requests for a song that is already being rendered wait for that
+rendering instead of starting another one. When ``max_pending`` songs
+are queued the server answers 503 until the workers catch up.
+"""
+import os
+import sys
+import time
+import json
+import Queue
+import errno
+import socket
+import urlparse
+import threading
+import traceback
+import multiprocessing
+from collections import deque
+from cStringIO import StringIO
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn, UnixStreamServer
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from realbook.layout import LayoutCache
+from render import parse_song, render_score, decode_song, page_sizes
+from bench import Corpus
+import batch
+
+content_types = {
+    'pdf': 'application/pdf',
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+# measure layouts kept by a worker for all its songs
+layout_cache = None
+# queue of the (task, pid) of the renderings started by a worker
+started = None
+
+def init_worker(ttf_dir=None, parse_cache_dir=None, started_queue=None):
+    global layout_cache, started
+    batch.init_worker(ttf_dir, parse_cache_dir)
+    layout_cache = LayoutCache()
+    # fills the text metrics and glyph caches before the first request
+    for fmt in ('pdf', 'png'):
+        render_request((Corpus().songs(1)[0], fmt, 100))
+    started = started_queue
+
+def render_request(request, task=None):
+    """Renders (song, fmt, dpi) in a worker; returns (data, seconds,
+    error). The start of the ``task`` is told to the RenderService."""
+    if task is not None and started is not None:
+        started.put((task, os.getpid()))
+    s, fmt, dpi = request
+    t = time.time()
+    try:
+        f = StringIO()
+        render_score(parse_song(s, batch.parse_cache,
+            layout_cache=layout_cache), f, fmt, None, dpi)
+    except Exception:
+        return None, time.time() - t, traceback.format_exc()
+    return f.getvalue(), time.time() - t, None
+
+class ServiceBusy(Exception):
+    """Raised when too many songs wait for a worker."""
+
+class RenderError(Exception):
+    """Raised when a song cannot be rendered; holds the worker traceback."""
+
+class ServiceStats:
+    """Counters and latencies of a RenderService.
+
+    ``latencies`` keeps the wall time of the last ``window`` answered
+    requests, from their arrival to the answer, coalesced ones included.
+    """
+
+    def __init__(self, window=1024):
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.render_time = 0.0
+        self.requests = 0
+        self.rendered = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.failures = 0
+
+    def add(self, name, n=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def answered(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def percentile(self, p):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return 0.0
+        return latencies[min(int(len(latencies)*p), len(latencies) - 1)]
+
+    def as_dict(self):
+        elapsed = time.time() - self.start_time
+        return {
+            'uptime': elapsed,
+            'requests': self.requests,
+            'rendered': self.rendered,
+            'coalesced': self.coalesced,
+            'rejected': self.rejected,
+            'failed': self.failures,
+            'render_time': self.render_time,
+            'songs_per_second': elapsed and self.rendered / elapsed or 0.0,
+            'latency_p50': self.percentile(0.5),
+            'latency_p90': self.percentile(0.9),
+            'latency_p99': self.percentile(0.99),
+        }
+
+class PendingRender:
+    """A song being rendered, shared by the requests that asked for it."""
+
+    def __init__(self, task):
+        self.task = task
+        self.done = threading.Event()
+        self.data = self.error = None
+
+class RenderService:
+    """Renders songs on a pool of warm worker processes.
+
+    ``max_pending`` bounds the songs queued or being rendered; render()
+    raises ServiceBusy beyond it. ``timeout`` is the seconds a request
+    waits for its song. A song whose worker died, or that is not rendered
+    in time, fails and leaves its place to the next ones.
+    """
+
+    def __init__(self, processes=None, max_pending=64, timeout=60,
+                 ttf_dir=None, parse_cache_dir=None):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.started = multiprocessing.Queue()
+        self.pool = multiprocessing.Pool(processes, init_worker,
+            (ttf_dir, parse_cache_dir, self.started))
+        # (song, fmt, dpi): PendingRender
+        self.pending = {}
+        # task: (song, fmt, dpi), PendingRender
+        self.tasks = {}
+        # task: pid of the worker rendering it
+        self.running = {}
+        self.next_task = 0
+        self.lock = threading.Lock()
+        self.stats = ServiceStats()
+        self.closed = False
+        self.watcher = threading.Thread(target=self.watch)
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def __repr__(self):
+        return '<RenderService %d pending>' %len(self.pending)
+
+    def render(self, s, fmt='pdf', dpi=100):
+        """Returns the ``fmt`` data of the irealbook:// string ``s``."""
+        if fmt not in page_sizes:
+            raise ValueError('unknown output format: %s' %fmt)
+        t = time.time()
+        stats = self.stats
+        stats.add('requests')
+        key = (decode_song(s), fmt, dpi)
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending is not None:
+                stats.add('coalesced')
+            elif len(self.pending) >= self.max_pending:
+                stats.add('rejected')
+                raise ServiceBusy('%d songs pending' %len(self.pending))
+            else:
+                task = self.next_task
+                self.next_task += 1
+                pending = self.pending[key] = PendingRender(task)
+                self.tasks[task] = key, pending
+                self.pool.apply_async(render_request, (key, task),
+                    callback=lambda result: self.finish(task, result))
+        if not pending.done.wait(self.timeout):
+            self.abandon(pending.task, 'timed out after %ds' %self.timeout)
+        stats.answered(time.time() - t)
+        if pending.error:
+            stats.add('failures')
+            raise RenderError(pending.error)
+        return pending.data
+
+    def remove(self, task):
+        """Forgets a task; returns its PendingRender, None when the task
+        is already finished or abandoned."""
+        with self.lock:
+            key, pending = self.tasks.pop(task, (None, None))
+            self.running.pop(task, None)
+            if pending is not None and self.pending.get(key) is pending:
+                del self.pending[key]
+        return pending
+
+    def finish(self, task, result):
+        data, seconds, error = result
+        pending = self.remove(task)
+        if pending is None:
+            return
+        if not error:
+            self.stats.add('rendered')
+            self.stats.add('render_time', seconds)
+        pending.data, pending.error = data, error
+        pending.done.set()
+
+    def abandon(self, task, error):
+        """Fails the requests waiting for ``task``; its result, if any,
+        is dropped."""
+        pending = self.remove(task)
+        if pending is None:
+            return
+        pending.error = error
+        pending.done.set()
+
+    def watch(self):
+        """Abandons the tasks of the workers that died: the pool starts
+        new workers but never returns the tasks they were rendering."""
+        while not self.closed:
+            try:
+                task, pid = self.started.get(True, 0.5)
+            except (Queue.Empty, IOError, EOFError):
+                pass
+            else:
+                with self.lock:
+                    if task in self.tasks:
+                        self.running[task] = pid
+            with self.lock:
+                running = self.running.items()
+            for task, pid in running:
+                try:
+                    os.kill(pid, 0)
+                except OSError, e:
+                    if e.errno == errno.ESRCH:
+                        self.abandon(task, 'the worker rendering the song '
+                            'died')
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.closed = True
+        self.watcher.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.closed = True
+        self.watcher.join()
+
+class RenderHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path == '/stats':
+            self.answer(200, 'application/json',
+                json.dumps(self.server.service.stats.as_dict(), indent=2))
+        elif url.path == '/render':
+            self.render(query.get('song', [''])[0], query)
+        else:
+            self.answer(404, 'text/plain', 'not found\n')
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/render':
+            self.answer(404, 'text/plain', 'not found\n')
+            return
+        length = int(self.headers.getheader('content-length') or 0)
+        self.render(self.rfile.read(length), urlparse.parse_qs(url.query))
+
+    def render(self, s, query):
+        fmt = query.get('format', ['pdf'])[0]
+        try:
+            dpi = int(query.get('dpi', ['100'])[0])
+        except ValueError:
+            dpi = 0
+        if fmt not in content_types or dpi <= 0 or not s.strip():
+            self.answer(400, 'text/plain', 'a song, a format (pdf, png, svg) '
+                'and a positive dpi are required\n')
+            return
+        try:
+            data = self.server.service.render(s, fmt, dpi)
+        except ServiceBusy, e:
+            self.answer(503, 'text/plain', '%s\n' %e, {'Retry-After': '1'})
+        except RenderError, e:
+            # the last line of the traceback of the worker
+            self.answer(500, 'text/plain',
+                '%s\n' %str(e).strip().splitlines()[-1])
+        else:
+            self.answer(200, content_types[fmt], data)
+
+    def answer(self, code, content_type, data, headers={}):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # the clients of a Unix socket have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class RenderHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    quiet = False
+
+class UnixRenderServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    quiet = False
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        UnixStreamServer.server_bind(self)
+        # like HTTPServer.server_bind, for BaseHTTPRequestHandler
+        self.server_name = socket.gethostname()
+        self.server_port = 0
+
+def make_server(service, host='127.0.0.1', port=8420, unix_socket=None):
+    if unix_socket:
+        server = UnixRenderServer(unix_socket, RenderHandler)
+    else:
+        server = RenderHTTPServer((host, port), RenderHandler)
+    server.service = service
+    return server
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='127.0.0.1',
+        help='address to listen on [%default]')
+    parser.add_option('-p', '--port', type='int', default=8420,
+        help='port to listen on [%default]')
+    parser.add_option('-u', '--unix-socket', default=None,
+        help='listen on this Unix socket instead of tcp')
+    parser.add_option('-j', '--jobs', type='int', default=None,
+        help='number of worker processes [number of cpus]')
+    parser.add_option('--max-pending', type='int', default=64,
+        help='songs queued before answering 503 [%default]')
+    parser.add_option('--timeout', type='int', default=60,
+        help='seconds a request waits for its song [%default]')
+    parser.add_option('--ttf-dir', default=None,
+        help='directory of the Jazz fonts')
+    parser.add_option('--parse-cache', default=None,
+        help='directory of the cache of the parsed songs')
+    parser.add_option('-q', '--quiet', action='store_true', default=False)
+    options, args = parser.parse_args(argv)
+    service = RenderService(options.jobs, options.max_pending,
+        options.timeout, options.ttf_dir, options.parse_cache)
+    server = make_server(service, options.host, options.port,
+        options.unix_socket)
+    server.quiet = options.quiet
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.terminate()
+        sys.stderr.write('%s\n' %json.dumps(service.stats.as_dict(),
+            indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright (C) 2010 Vittorio Palmisano <vpalmisano at gmail dot com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+"""Tokenizer of the song part of the irealbook:// strings.
+
+tokenize() turns the song into a stream of (kind, value, position)
+tuples, walking the string once with a compiled pattern and never
+copying its tail, so the time spent is linear in the length of the
+song. The kinds are:
+
+    barline     one of | { [ } ]
+    section     A, B, C, D or i (intro)
+    time        the two digits following T
+    chord       root, quality and bass of a chord, e.g. 'Bb-7/Ab'
+    space       a run of spaces, the value is its length
+    comma       chord separator
+    ending      the ending number following N
+    small       s, the following chords are small
+    large       l, the following chords are normal sized
+    final       Z or =, end of the song
+    repeat      one of % x n r
+    alternate   (, the following chord is an alternate one
+    close       )
+    comment     the text between < and >
+    segno       S
+    coda        Q
+    fermata     f
+    text        any other character, appended to the current chord
+
+The star of the unknown * markers and the Y and p characters are skipped.
+"""
+import re
+import sys
+import time
+
+TOKEN_RE = re.compile(r'''
+      (?P<barline>[|{\[}\]])
+    | \*(?P<section>[ABCDi])
+    | (?P<star>\*)
+    | T(?P<time>..)
+    | (?P<chord>[A-G][#b]?(?:sus|add|alt|Maj|[0-9#b^+\-hom])*(?:/[A-G][#b]?)?)
+    | (?P<space>\ +)
+    | (?P<comma>,)
+    | N(?P<ending>.)
+    | (?P<small>s(?!us))
+    | (?P<large>l(?=[A-G]))
+    | (?P<final>[Z=])
+    | (?P<ignore>[Yp])
+    | (?P<repeat>[%xnr])
+    | (?P<alternate>\()
+    | (?P<close>\))
+    | <(?P<comment>[^>]*)>?
+    | (?P<segno>S)
+    | (?P<coda>Q)
+    | (?P<fermata>f)
+    | (?P<text>sus|.)
+''', re.S | re.X)
+
+def tokenize(song):
+    match = TOKEN_RE.match
+    pos, end = 0, len(song)
+    while pos < end:
+        m = match(song, pos)
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == 'space':
+            value = len(value)
+        if kind not in ('star', 'ignore'):
+            yield kind, value, pos
+        if kind == 'final':
+            return
+        if kind == 'repeat' and value == 'r':
+            # the rest of the repeated measures is skipped up to the
+            # character preceding the next barline
+            j = song.find('|', pos+2)
+            pos = j == -1 and end or max(j-1, pos+1)
+        else:
+            pos = m.end()
+
+def make_song(measures, comment_length=0):
+    """Builds a synthetic irealbook:// string with ``measures`` measures."""
+    bars = ('{*AT44C^7 A-7 |D-7 G7 |', 'E-7 A7 |D-9 G7b9 |',
+        'N1C6 A7 |D-7 G7 }', 'N2C6   ]', '*BF^7 Bb7 |E-7 A7 |',
+        'D7 x |G7sus r|', 'C/E Eb7 |fD-7 sG7 lC^7 |', 'C7(Db7) Q |S C^7 |')
+    parts = []
+    for i in xrange(measures):
+        parts.append(bars[i % len(bars)])
+        if comment_length and i % 4 == 0:
+            parts.append('<%s>' %('x'*comment_length))
+    return 'irealbook://Song=Author=Swing=C=n=%s Z' %''.join(parts)
+
+def bench(sizes=(100, 1000, 10000), repeat=3, out=sys.stdout):
+    """Times the tokenizer and the parser on long and adversarial inputs."""
+    from irealbook import parse
+    for n in sizes:
+        inputs = [
+            ('long', make_song(n)),
+            ('comments', make_song(n, comment_length=200)),
+            ('unterminated', make_song(n/10)[:-1] + '<' + 'x'*n*10 + 'Z'),
+            ('stars', make_song(n/10)[:-1] + '*'*n*10 + 'Z'),
+            ('repeats', make_song(n/10)[:-1] + 'r'*n*10 + 'Z'),
+            ('spaces', make_song(n/10)[:-1] + ' '*n*10 + 'Z'),
+        ]
+        for name, s in inputs:
+            song = s.split('=', 5)[-1]
+            best = None
+            for i in xrange(repeat):
+                t = time.time()
+                count = 0
+                for token in tokenize(song):
+                    count += 1
+                t = time.time() - t
+                best = best is None and t or min(best, t)
+            line = '%-12s %8d chars %8d tokens %9.2f ms %8.2f MB/s' %(name,
+                len(song), count, best*1000, len(song)/(best or 1e-9)/1e6)
+            t = time.time()
+            try:
+                parse(s)
+            except Exception, e:
+                line += ' parse %s' %e.__class__.__name__
+            else:
+                line += ' parse %9.2f ms' %((time.time()-t)*1000)
+            out.write(line + '\n')
+
+if __name__ == '__main__':
+    bench()
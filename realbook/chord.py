@@ -18,6 +18,11 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 #
 import math
+import time
+from operator import attrgetter
+from collections import namedtuple
+
+from layout import content_property
 
 chord_table = {
     'm':    u'-',
@@ -83,33 +88,111 @@ chord_table = {
     '11': u'11',
 }
 
-class Chord:
+class ChordError(ValueError):
+    pass
+
+# a chord symbol split into its parts; glyphs is the text of the quality
+# in the JazzCord font
+ChordSymbol = namedtuple('ChordSymbol', ('text', 'root', 'accidental',
+    'quality', 'glyphs', 'bass_root', 'bass_accidental'))
+
+_roots = ('A', 'B', 'C', 'D', 'E', 'F', 'G')
+_chord_symbols = {}
+
+def _split_root(text, chord):
+    if not text or text[0] not in _roots:
+        raise ChordError('invalid chord root in %r' %chord)
+    if len(text) > 1 and text[1] in ('#', 'b'):
+        return text[0], text[1], text[2:]
+    return text[0], '', text[1:]
+
+def parse_chord(text):
+    """Returns the interned ChordSymbol of a chord like 'Bb-7/Ab'.
+
+    Raises ChordError when the root, the quality or the bass of the chord
+    is unknown. Empty chords have no symbol.
+    """
+    if not text:
+        return None
+    symbol = _chord_symbols.get(text)
+    if symbol is not None:
+        return symbol
+    parts = text.split('/', 1)
+    if len(parts) == 2:
+        chord, bass = parts
+    else:
+        chord, bass = text, ''
+    root, accidental, quality = _split_root(chord, text)
+    if quality and quality not in chord_table:
+        raise ChordError('unknown chord quality %r in %r' %(quality, text))
+    if bass:
+        bass_root, bass_accidental, rest = _split_root(bass, text)
+        if rest:
+            raise ChordError('invalid bass in %r' %text)
+    else:
+        bass_root, bass_accidental = '', ''
+    symbol = ChordSymbol(text, root, accidental, quality,
+        quality and unicode(chord_table[quality]) or u'',
+        bass_root, bass_accidental)
+    return _chord_symbols.setdefault(text, symbol)
+
+class Chord(object):
+    # musical content, then drawing state set by reset_drawing()
+    __slots__ = ('measure', '_index', '_chord', '_symbol', '_alternate',
+                 '_small', '_fermata', 'dirty',
+                 'left', 'top', 'width', 'height')
     padding_bottom = 4
 
     def __init__(self, measure, index, chord='', small=False, alternate=False, 
-                 fermata=False):
+                 fermata=False, symbol=None):
         self.measure = measure
-        self.index = index
-        self.chord = chord
-        self.alternate = alternate
-        self.small = small
-        self.fermata = fermata
+        self._index = index
+        self._chord = chord
+        self._symbol = symbol or parse_chord(chord)
+        self._alternate = alternate
+        self._small = small
+        self._fermata = fermata
+        self.dirty = True
 
     def __repr__(self):
         return '<Chord: %s index: %d>' %(self.chord, self.index)
 
+    def _set_chord(self, chord):
+        self._chord = chord
+        self._symbol = parse_chord(chord)
+        self.touch()
+
+    # setting the content marks the chord, its measure and staff dirty
+    chord = property(attrgetter('_chord'), _set_chord)
+    index = content_property('index')
+    symbol = content_property('symbol')
+    alternate = content_property('alternate')
+    small = content_property('small')
+    fermata = content_property('fermata')
+
+    def touch(self):
+        self.dirty = True
+        if self.measure is not None:
+            self.measure.touch()
+
     def reset_drawing(self):
+        self.dirty = False
         self.height = 0
         self.width = 0
         self.top = 0
         self.left = 0
         self.height = 0
 
-    def draw(self, simulate=False):
+    def draw(self):
         self.reset_drawing()
         if not self.chord:
             return
-        cr = self.measure.staff.score.cr
+        score = self.measure.staff.score
+        stats = score.stats
+        if stats is not None:
+            t = time.time()
+        cr = score.cr
+        node = cr.begin('chord', self)
         left = max(self.measure.padding_left, self.measure.chords_left)
         width = (self.measure.width - self.measure.chords_padding_left) \
             / float(self.measure.num_chords())
@@ -117,101 +200,101 @@ class Chord:
         self.top = self.measure.staff.staff_lines_pos[0] - self.padding_bottom
         if self.alternate:
             self.top -= 32
-        # extract parts
-        parts = self.chord.split('/', 1)
-        if len(parts) == 2:
-            chord, bass = parts
-        else:
-            chord, bass = self.chord, ''
-        if len(chord) > 1 and chord[1] in ('#', 'b'):
-            chord_name, qual = chord[0:2], chord[2:]
-        else:
-            chord_name, qual = chord[0], chord[1:]
+        symbol = self.symbol
         # draw chord
-        self._draw_chord(chord_name, simulate)
+        self._draw_chord(symbol.root, symbol.accidental)
         # draw qualities
-        if qual:
-            cr.set_font_face(self.measure.staff.score.face_jazzcord)
-            if self.alternate or self.small:
-                cr.set_font_size(20)
-            else:
-                cr.set_font_size(30)
+        if symbol.quality:
+            face = self.measure.staff.score.face_jazzcord
+            size = self.font_size()
+            cr.set_font_face(face)
+            cr.set_font_size(size)
             cr.move_to(self.left, self.top)
-            text = unicode(chord_table[qual])
-            xbear, ybear, fwidth, fheight, xadv, yadv = cr.text_extents(text)
+            text = symbol.glyphs
+            xbear, ybear, fwidth, fheight, xadv, yadv = score.text_extents(
+                face, size, text)
             self.left += fwidth + 1
             self.width += fwidth + 1
-            if not simulate:
-                cr.show_text(text)
+            cr.show_text(text)
             self.height = max(self.height, fheight)
         # bass
-        if bass:
+        if symbol.bass_root:
             cr.set_font_face(self.measure.staff.score.face_jazz)
-            if self.alternate or self.small:
-                cr.set_font_size(10)
-            else:
-                cr.set_font_size(20)
+            cr.set_font_size(self.bass_font_size())
             cr.move_to(self.left, self.top+5)
             cr.rotate(-math.pi*0.25)
             text = str(u'Y')
-            xbear, ybear, fwidth, fheight, xadv, yadv = cr.text_extents(text)
             self.left += 7
             self.width += 7
-            if not simulate:
-                cr.show_text(text)
+            cr.show_text(text)
             cr.rotate(math.pi*0.25)
-            self._draw_chord(bass, simulate)
+            self._draw_chord(symbol.bass_root, symbol.bass_accidental)
         self.height += self.padding_bottom
         if self.alternate:
             self.height += 34
         if self.fermata:
-            self._draw_fermata(simulate)
+            self._draw_fermata()
         self.left = chord_left
+        node.set_box(self.left, self.measure.staff.staff_lines_pos[0]-self.height,
+            self.width, self.height)
+        cr.end()
+        if stats is not None:
+            stats.add('chord', time.time() - t)
+
+    def font_size(self):
+        if self.alternate or self.small:
+            return 20
+        return 30
+
+    def bass_font_size(self):
+        if self.alternate or self.small:
+            return 10
+        return 20
 
-    def _draw_chord(self, chord_name, simulate=False):
-        if len(chord_name) == 2:
-            chord_name, alt = chord_name
-        else:
-            alt = ''
+    def _draw_chord(self, chord_name, alt=''):
         cr = self.measure.staff.score.cr
+        score = self.measure.staff.score
+        size = self.font_size()
         # draw chord
-        cr.set_font_face(self.measure.staff.score.face_jazzcord)
-        if self.alternate or self.small:
-            cr.set_font_size(20)
-        else:
-            cr.set_font_size(30)
+        face = self.measure.staff.score.face_jazzcord
+        cr.set_font_face(face)
+        cr.set_font_size(size)
         cr.move_to(self.left, self.top)
         text = str(chord_name)
-        xbear, ybear, fwidth, fheight, xadv, yadv = cr.text_extents(text)
+        xbear, ybear, fwidth, fheight, xadv, yadv = score.text_extents(
+            face, size, text)
         self.height = max(self.height, fheight)
         self.left += fwidth + 1
         self.width += fwidth + 1
-        if not simulate:
-            cr.show_text(text)
+        cr.show_text(text)
         # draw # or b
         if alt:
-            cr.set_font_face(self.measure.staff.score.face_jazz)
+            face = self.measure.staff.score.face_jazz
+            cr.set_font_face(face)
             cr.move_to(self.left, self.top-fheight*.4)
             text = str(alt)
-            xbear, ybear, fwidth, fheight, xadv, yadv = cr.text_extents(text)
+            xbear, ybear, fwidth, fheight, xadv, yadv = score.text_extents(
+                face, size, text)
             self.height = max(self.height, fheight)
             self.left += fwidth
             self.width += fwidth
-            if not simulate:
-                cr.show_text(text)
+            cr.show_text(text)
 
-    def _draw_fermata(self, simulate):
+    def _draw_fermata(self):
         cr = self.measure.staff.score.cr
-        cr.set_font_face(self.measure.staff.score.face_jazz)
+        face = self.measure.staff.score.face_jazz
+        size = self.font_size()
+        cr.set_font_face(face)
+        cr.set_font_size(size)
         text = u'U'
-        xbear, ybear, fwidth, fheight, xadv, yadv = cr.text_extents(text)
+        xbear, ybear, fwidth, fheight, xadv, yadv = \
+            self.measure.staff.score.text_extents(face, size, text)
         left = max(self.measure.padding_left, self.measure.chords_left)
         width = (self.measure.width - self.measure.chords_padding_left) \
             / float(self.measure.num_chords())
         left = left + self.index*width
         top = self.measure.staff.staff_lines_pos[0] - self.height
         cr.move_to(left, top)
-        if not simulate:
-            cr.show_text(text)
+        cr.show_text(text)
         self.height += fheight
 
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright (C) 2010 Vittorio Palmisano <vpalmisano at gmail dot com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+import math
+import threading
+from operator import attrgetter
+from collections import OrderedDict
+
+def content_property(name):
+    """Attribute kept in the slot '_name' that calls the touch() method
+    of its object when set, so the next MusicScore.relayout lays it out
+    again."""
+    slot = '_' + name
+    def set(self, value):
+        setattr(self, slot, value)
+        self.touch()
+    return property(attrgetter(slot), set)
+
+def merge_bands(bands):
+    """Merges the overlapping (top, bottom) bands."""
+    merged = []
+    for top, bottom in sorted(bands):
+        if merged and top <= merged[-1][1]:
+            if bottom > merged[-1][1]:
+                merged[-1] = (merged[-1][0], bottom)
+        else:
+            merged.append((top, bottom))
+    return merged
+
+class LayoutNode:
+    """A node of the geometry tree computed by the layout pass.
+
+    ``ops`` holds, in drawing order, the cairo calls of the node as
+    ``(method, args)`` tuples and the child nodes. ``x``, ``y``, ``width``
+    and ``height`` are the bounding box of the node in the coordinates of
+    its parent; ``dx`` and ``dy`` are an offset applied to the contents
+    of the node when rendering (the measures of a staff are shifted down
+    by the height of their chords and symbols, a reused measure layout is
+    moved to the position of the measure).
+    """
+
+    def __init__(self, kind, obj=None):
+        self.kind = kind
+        self.obj = obj
+        self.ops = []
+        self.children = []
+        self.x = self.y = 0
+        self.width = self.height = 0
+        self.dx = self.dy = 0
+
+    def __repr__(self):
+        return '<LayoutNode %s (%g, %g, %g, %g)>' %(self.kind,
+            self.x, self.y, self.width, self.height)
+
+    def add(self, node):
+        self.ops.append(node)
+        self.children.append(node)
+        return node
+
+    def set_box(self, x, y, width, height):
+        self.x, self.y, self.width, self.height = x, y, width, height
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            for node in child.walk():
+                yield node
+
+    def find(self, kind):
+        return [node for node in self.walk() if node.kind == kind]
+
+    def clone(self, obj):
+        """Copy of the subtree; the drawing calls are shared and ``obj``
+        maps the object of every node to the one of its copy."""
+        node = LayoutNode(self.kind, obj(self.obj))
+        node.x, node.y, node.width, node.height = \
+            self.x, self.y, self.width, self.height
+        node.dx, node.dy = self.dx, self.dy
+        for op in self.ops:
+            if isinstance(op, LayoutNode):
+                node.add(op.clone(obj))
+            else:
+                node.ops.append(op)
+        return node
+
+    def render(self, cr):
+        moved = self.dx or self.dy
+        if moved:
+            cr.translate(self.dx, self.dy)
+        for op in self.ops:
+            if isinstance(op, LayoutNode):
+                op.render(cr)
+            else:
+                getattr(cr, op[0])(*op[1])
+        if moved:
+            cr.translate(-self.dx, -self.dy)
+
+class LayoutContext:
+    """Stand-in for a cairo.Context used while laying out a score.
+
+    The drawing calls are recorded into the current LayoutNode instead
+    of being painted; ``begin`` and ``end`` open and close the nodes.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.stack = [root]
+
+    def begin(self, kind, obj=None):
+        node = self.stack[-1].add(LayoutNode(kind, obj))
+        self.stack.append(node)
+        return node
+
+    def end(self):
+        return self.stack.pop()
+
+    def add(self, node):
+        return self.stack[-1].add(node)
+
+class GlyphRunRenderer:
+    """Renders a layout like LayoutNode.render, drawing its text as runs
+    of glyphs.
+
+    Every text is converted to glyphs once per font and size (see
+    realbook.metrics.TextGlyphs); the glyphs of a staff, or of the head
+    of the score, are drawn by one show_glyphs call per font face, size
+    and colour when the node ends. Rotated text is drawn with show_text.
+    """
+    batch = ('staff', 'head')
+
+    def __init__(self, cr, glyphs):
+        self.cr = cr
+        self.glyphs = glyphs
+        xx, yx, xy, yy, x0, y0 = cr.get_matrix()
+        self.matrix = (xx, yx, xy, yy)
+        self.runs = OrderedDict()
+        self.calls = 0
+        # font, colour, translation, rotation and current point of the
+        # context, relative to its state when the rendering starts
+        self.face = self.size = None
+        self.rgb = (0, 0, 0)
+        self.tx = self.ty = self.angle = 0
+        self.point = (0, 0)
+        self.stack = []
+
+    def render(self, node):
+        moved = node.dx or node.dy
+        if moved:
+            self.translate(node.dx, node.dy)
+        for op in node.ops:
+            if isinstance(op, LayoutNode):
+                self.render(op)
+                continue
+            name, args = op
+            if name == 'show_text':
+                if self.show_text(args[0]):
+                    continue
+            elif name == 'translate':
+                self.translate(*args)
+                continue
+            elif name in ('move_to', 'line_to'):
+                self.point = args
+            elif name == 'set_font_face':
+                self.face = args[0]
+            elif name == 'set_font_size':
+                self.size = args[0]
+            elif name == 'set_source_rgb':
+                self.rgb = args
+            elif name == 'rotate':
+                self.angle += args[0]
+            elif name == 'save':
+                self.stack.append((self.face, self.size, self.rgb,
+                    self.tx, self.ty, self.angle))
+            elif name == 'restore':
+                self.face, self.size, self.rgb, self.tx, self.ty, \
+                    self.angle = self.stack.pop()
+            getattr(self.cr, name)(*args)
+        if moved:
+            self.translate(-node.dx, -node.dy)
+        if node.kind in self.batch:
+            self.flush()
+
+    def translate(self, x, y):
+        self.cr.translate(x, y)
+        if self.angle:
+            c, s = math.cos(self.angle), math.sin(self.angle)
+            x, y = x*c - y*s, x*s + y*c
+        self.tx += x
+        self.ty += y
+
+    def show_text(self, text):
+        """Adds the glyphs of ``text`` to the run of the current font,
+        returns False when the text is to be drawn by show_text."""
+        if self.face is None or abs(math.sin(self.angle)) > 1e-9 or \
+                math.cos(self.angle) < 0:
+            return False
+        glyphs, xadv, yadv = self.glyphs.glyphs(self.cr, self.face,
+            self.size, text, self.matrix)
+        x, y = self.point
+        self.point = (x + xadv, y + yadv)
+        x += self.tx
+        y += self.ty
+        run = self.runs.get((self.face, self.size, self.rgb))
+        if run is None:
+            run = self.runs[(self.face, self.size, self.rgb)] = []
+        run.extend((i, x + gx, y + gy) for i, gx, gy in glyphs)
+        return True
+
+    def flush(self):
+        """Draws the pending runs of glyphs."""
+        if not self.runs:
+            return
+        cr = self.cr
+        cr.save()
+        # back to the coordinates of the start of the rendering
+        if self.angle:
+            cr.rotate(-self.angle)
+        cr.translate(-self.tx, -self.ty)
+        for (face, size, rgb), glyphs in self.runs.items():
+            cr.set_font_face(face)
+            cr.set_font_size(size)
+            cr.set_source_rgb(*rgb)
+            cr.show_glyphs(glyphs)
+            self.calls += 1
+        cr.restore()
+        self.runs.clear()
+
+def render_glyph_runs(node, cr, glyphs):
+    """Renders ``node`` on ``cr`` with a GlyphRunRenderer, returns the
+    number of show_glyphs calls."""
+    renderer = GlyphRunRenderer(cr, glyphs)
+    renderer.render(node)
+    renderer.flush()
+    return renderer.calls
+
+class LayoutCache:
+    """Bounded LRU cache of measure layouts keyed by the content
+    signature of the measures (see Measure.signature).
+
+    The equal measures of a song are always laid out once; a LayoutCache
+    passed to MusicScore shares the layouts across songs too. Its entries
+    do not refer to the measures they come from.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return '<LayoutCache %d/%d entries, %d hits, %d misses>' %(
+            len(self.cache), self.maxsize, self.hits, self.misses)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.cache.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.cache[key] = entry
+            self.hits += 1
+            return entry
+
+    def set(self, key, entry):
+        with self.lock:
+            self.cache[key] = entry
+            if len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.cache),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': total and float(self.hits)/total or 0.0,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+def _recorder(name):
+    def record(self, *args):
+        self.stack[-1].ops.append((name, args))
+    record.__name__ = name
+    return record
+
+for _name in ('save', 'restore', 'translate', 'rotate',
+              'set_source_rgb', 'set_line_width',
+              'set_font_face', 'set_font_size',
+              'move_to', 'line_to', 'arc', 'rectangle',
+              'stroke', 'fill', 'show_text'):
+    setattr(LayoutContext, _name, _recorder(_name))
@@ -18,8 +18,11 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 #
 import math
+import time
 from chord import Chord
 from symbol import Symbol
+from skyline import Skyline
+from layout import content_property
 
 def make_key_signatures():
     key_signatures = {}
@@ -59,36 +62,100 @@ def make_key_signatures():
     key_signatures['Bb']['min'] = key_signatures['Db']['maj']
     return key_signatures
 
-class Measure:
+# the key signatures never change: a single table, with tuples of notes,
+# is shared by all the measures
+key_signatures = dict((key, dict((mode, tuple(notes))
+        for mode, notes in modes.items()))
+    for key, modes in make_key_signatures().items())
+
+_note_offsets = {}
+def note_offsets(d):
+    """Offsets from the top staff line of the notes of the key signatures,
+    for a staff with lines ``d`` apart."""
+    offsets = _note_offsets.get(d)
+    if offsets is None:
+        offsets = _note_offsets[d] = {
+            'G5': -(d/2),
+            'F5': 0,
+            'E5': d/2.,
+            'D5': d,
+            'C5': d+d/2.,
+            'B4': 2*d,
+            'A4': 2*d+d/2.,
+            'G4': 3*d,
+            'F4': 3*d+d/2,
+        }
+    return offsets
+
+_key_signature_offsets = {}
+def key_signature_offsets(key, mode, d):
+    """Returns the (offset, accidental) tuples of a key signature."""
+    offsets = _key_signature_offsets.get((key, mode, d))
+    if offsets is None:
+        notes = note_offsets(d)
+        offsets = _key_signature_offsets[(key, mode, d)] = tuple(
+            (notes[note[:2]], note[2]) for note in key_signatures[key][mode])
+    return offsets
+
+class Measure(object):
+    # musical content, then drawing state set by reset_drawing(); the
+    # drawing state stays here rather than in a slotted object of its
+    # own, which would save its 8 empty slots before the layout but add
+    # 112 bytes of object per laid out measure (see parser.bench --memory)
+    __slots__ = ('staff', '_index', '_time', '_key_signature',
+                 '_start_barline', '_stop_barline', '_ending', '_section',
+                 '_empty', 'chords', 'symbols', 'dirty',
+                 'padding_left', 'width', 'height', 'top_height',
+                 'bottom_height', 'chords_left', 'chords_padding_left',
+                 'skyline')
+    key_signatures = key_signatures
+
     def __init__(self, staff, index=0, time=(), key_signature=(), 
                  start_barline='single', stop_barline='single',
                  ending='', section='', empty=False):
         self.staff = staff
-        self.index = index
-        self.time = time
-        self.start_barline = start_barline
-        self.stop_barline = stop_barline
-        self.ending = ending
-        self.section = section
-        self.empty = empty
+        self._index = index
+        self._time = time
+        self._start_barline = start_barline
+        self._stop_barline = stop_barline
+        self._ending = ending
+        self._section = section
+        self._empty = empty
         self.chords = []
         self.symbols = []
-        self.key_signature = key_signature
-        self.key_signatures = make_key_signatures()
-        # drawing properties
-        self.reset_drawing()
+        self._key_signature = key_signature
+        self.dirty = True
 
     def __repr__(self):
         return '<Measure %d>' %(self.index)
 
+    # setting the content marks the measure and its staff dirty
+    index = content_property('index')
+    time = content_property('time')
+    key_signature = content_property('key_signature')
+    start_barline = content_property('start_barline')
+    stop_barline = content_property('stop_barline')
+    ending = content_property('ending')
+    section = content_property('section')
+    empty = content_property('empty')
+
+    def touch(self):
+        """Marks the measure dirty; call it after changing the chords or
+        symbols lists in place."""
+        self.dirty = True
+        if self.staff is not None:
+            self.staff.touch()
+
     def add_chord(self, index, chord='', **kw):
         c = Chord(self, index, chord, **kw)
         self.chords.append(c)
+        self.touch()
         return c
 
     def add_symbol(self, index, symbol='', **kw):
         s = Symbol(self, index, symbol, **kw)
         self.symbols.append(s)
+        self.touch()
         return s
 
     def add_chords(self, chords, **kw):
@@ -97,6 +164,7 @@ class Measure:
             c = Chord(self, i, chords[i], **kw)
             self.chords.append(c)
             added.append(c)
+        self.touch()
         return added
 
     def num_chords(self):
@@ -110,6 +178,7 @@ class Measure:
         return self.height + self.top_height + self.bottom_height
 
     def reset_drawing(self):
+        self.dirty = False
         self.padding_left = 0
         self.width = 0
         self.height = 0
@@ -117,16 +186,122 @@ class Measure:
         self.bottom_height = 0
         self.chords_left = 0
         self.chords_padding_left = 0
-        self.top_heights = []
+        self.skyline = Skyline()
+
+    def signature(self, width):
+        """Content signature of the measure: the measures with equal
+        signatures are laid out alike, up to their position."""
+        score = self.staff.score
+        return (score.face_jazz, score.face_jazztext, score.face_jazzcord,
+            width, self.staff.lines_distance,
+            self.index == 0 and self.staff.index == 0,
+            self.time, self.key_signature, self.start_barline,
+            self.stop_barline, self.ending, self.section, self.empty,
+            tuple((c.index, c.chord, c.small, c.alternate, c.fermata)
+                for c in self.chords),
+            tuple((s.index, s.symbol) for s in self.symbols))
 
-    def draw(self, width, simulate=False):
+    def draw(self, width):
+        score = self.staff.score
+        stats = score.stats
+        if stats is not None:
+            t = time.time()
         self.reset_drawing()
         self.width = width
-        self.simulate = simulate
         self.height = self.staff.staff_lines_pos[-1]-self.staff.staff_lines_pos[0]
-        cr = self.staff.score.cr
-        self.padding_left = self.staff.score.padding_left+self.index*self.width
-        #
+        cr = score.cr
+        left, top = score.padding_left+self.index*self.width, self.staff.top
+        self.padding_left = left
+        layouts = score.measure_layouts
+        if layouts is not None:
+            key = self.signature(width)
+            layout = layouts.get(key)
+            if layout is None and score.layout_cache is not None:
+                layout = score.layout_cache.get(key)
+            if layout is not None:
+                cr.add(self.reuse_layout(layout, left, top))
+                if stats is not None:
+                    stats.count('measures_reused')
+                    stats.add('measure', time.time() - t)
+                return
+        node = cr.begin('measure', self)
+        self._draw()
+        node.set_box(left, self.staff.staff_lines_pos[0]-self.top_height,
+            self.width, self.total_height())
+        cr.end()
+        if layouts is not None:
+            layouts[key] = (self, node, left, top)
+            if score.layout_cache is not None:
+                score.layout_cache.set(key, self.save_layout(node, left, top))
+        if stats is not None:
+            stats.add('measure', time.time() - t)
+
+    def drawing_state(self):
+        items = []
+        for chord in self.chords:
+            items.append(chord.chord and
+                (chord.left, chord.top, chord.width, chord.height))
+        for symbol in self.symbols:
+            items.append(symbol.symbol and
+                (symbol.left, symbol.top, symbol.width, symbol.height))
+        return (self.padding_left, self.top_height, self.bottom_height,
+            self.chords_left, self.chords_padding_left, self.skyline, items)
+
+    def save_layout(self, node, left, top):
+        """The layout of the measure at (left, top), with no references to
+        the measure and its chords, to be reused by other songs."""
+        objs = {id(self): None}
+        for i, c in enumerate(self.chords):
+            objs[id(c)] = ('chords', i)
+        for i, s in enumerate(self.symbols):
+            objs[id(s)] = ('symbols', i)
+        return (None, node.clone(lambda obj: objs[id(obj)]), left, top,
+            self.drawing_state())
+
+    def reuse_layout(self, layout, left, top):
+        """Takes the drawing state of the measure from the layout of an
+        equal measure and returns a copy of its node moved to (left, top).
+
+        ``layout`` is (measure, node, left, top) for a measure of the same
+        score, optionally followed by the drawing state of the measure
+        when it was laid out, or the tuple returned by save_layout.
+        """
+        source, node, x0, y0 = layout[:4]
+        if len(layout) > 4:
+            state = layout[4]
+        else:
+            state = source.drawing_state()
+        if source is None:
+            obj = lambda obj: obj is None and self or getattr(self, obj[0])[obj[1]]
+        elif source is self:
+            obj = lambda obj: obj
+        else:
+            objs = {id(source): self}
+            for a, b in zip(source.chords, self.chords):
+                objs[id(a)] = b
+            for a, b in zip(source.symbols, self.symbols):
+                objs[id(a)] = b
+            obj = lambda obj: objs[id(obj)]
+        dx, dy = left - x0, top - y0
+        padding_left, self.top_height, self.bottom_height, chords_left, \
+            self.chords_padding_left, skyline, items = state
+        self.padding_left = padding_left + dx
+        self.chords_left = chords_left and chords_left + dx
+        self.skyline = skyline.shifted(dx)
+        for item, box in zip(self.chords + self.symbols, items):
+            item.reset_drawing()
+            if box:
+                item.left, item.top, item.width, item.height = box
+                item.left += dx
+                item.top += dy
+        node = node.clone(obj)
+        node.dx += dx
+        node.dy += dy
+        node.x += dx
+        node.y += dy
+        return node
+
+    def _draw(self):
         if self.empty:
             return
         self.draw_lines()
@@ -145,26 +320,33 @@ class Measure:
             self.draw_section()
         # draw chords
         for chord in self.chords:
-            chord.draw(simulate=self.simulate)
+            chord.draw()
             self.top_height = max(self.top_height, chord.height)
-            self.top_heights.append((chord.left, chord.width, chord.height))
+            self.skyline.add(chord.left, chord.width, chord.height)
         # draw symbols
         for symbol in self.symbols:
-            symbol.draw(simulate=self.simulate)
+            symbol.draw()
             self.top_height = max(self.top_height, symbol.height)
-            self.top_heights.append((symbol.left, symbol.width, symbol.height))
+            self.skyline.add(symbol.left, symbol.width, symbol.height)
         if self.ending:
             self.draw_ending()
 
-    def get_measure_height(self, position):
-        for left, width, height in self.top_heights:
-            if left <= position and (left+width) >= position:
-                return height
-        return 0
+    def get_measure_height(self, left, right=None):
+        """Height of the tallest item drawn above the staff over
+        [left, right] (or at ``left``)."""
+        if right is None:
+            right = left
+        return self.skyline.max_height(left, right)
+
+    def text_extents(self, face, size, text):
+        return self.staff.score.text_extents(face, size, text)
+
+    def begin_barline(self, left):
+        node = self.staff.score.cr.begin('barline', self)
+        node.set_box(left, self.staff.staff_lines_pos[0], 0, self.height)
+        return node
 
     def draw_lines(self):
-        if self.simulate:
-            return
         cr = self.staff.score.cr
         cr.set_source_rgb(0, 0, 0)
         cr.set_line_width(0.5)
@@ -177,21 +359,25 @@ class Measure:
 
     def draw_clef(self):
         cr = self.staff.score.cr
+        node = cr.begin('clef', self)
         cr.set_font_face(self.staff.score.face_jazz)
         cr.set_font_size(30)
-        xbear, ybear, fwidth, fheight, xadv, yadv = cr.text_extents('V')
+        xbear, ybear, fwidth, fheight, xadv, yadv = self.text_extents(
+            self.staff.score.face_jazz, 30, 'V')
         self.padding_left += 2
         cr.move_to(self.padding_left, self.staff.staff_lines_pos[3])
-        if not self.simulate:
-            cr.show_text('&')
+        cr.show_text('&')
         # update dist
         top_dist = self.staff.staff_lines_pos[3]-self.staff.staff_lines_pos[0]
         height = -ybear - top_dist
         self.top_height =  max(self.top_height, height)
-        self.top_heights.append((self.padding_left, fwidth+2, height))
+        self.skyline.add(self.padding_left, fwidth+2, height)
+        node.set_box(self.padding_left, self.staff.staff_lines_pos[3]+ybear,
+            fwidth, fheight)
         self.padding_left += fwidth + 2
         bottom_dist = self.staff.staff_lines_pos[-1]-self.staff.staff_lines_pos[3]
         self.bottom_height = max(self.bottom_height, fheight + ybear - bottom_dist)
+        cr.end()
 
     def draw_start_barline(self):
         if self.start_barline == 'single':
@@ -214,113 +400,127 @@ class Measure:
             self.draw_measure_stop_final()
 
     def draw_measure_start(self):
-        if not self.simulate:
-            cr = self.staff.score.cr
-            cr.set_source_rgb(0, 0, 0)
-            cr.set_line_width(1.0)
-            cr.move_to(self.padding_left, self.staff.staff_lines_pos[0])
-            cr.line_to(self.padding_left, self.staff.staff_lines_pos[-1])
-            cr.stroke()
+        cr = self.staff.score.cr
+        self.begin_barline(self.padding_left)
+        cr.set_source_rgb(0, 0, 0)
+        cr.set_line_width(1.0)
+        cr.move_to(self.padding_left, self.staff.staff_lines_pos[0])
+        cr.line_to(self.padding_left, self.staff.staff_lines_pos[-1])
+        cr.stroke()
+        cr.end()
         self.padding_left += 2
     
     def draw_measure_start_double(self):
         cr = self.staff.score.cr
-        if not self.simulate:
-            cr.set_source_rgb(0, 0, 0)
-            cr.set_line_width(1.0)
-            cr.move_to(self.padding_left, self.staff.staff_lines_pos[0])    
-            cr.line_to(self.padding_left, self.staff.staff_lines_pos[-1])
-            cr.move_to(self.padding_left+3, self.staff.staff_lines_pos[0])
-            cr.line_to(self.padding_left+3, self.staff.staff_lines_pos[-1])
-            cr.stroke()
+        self.begin_barline(self.padding_left).width = 3
+        cr.set_source_rgb(0, 0, 0)
+        cr.set_line_width(1.0)
+        cr.move_to(self.padding_left, self.staff.staff_lines_pos[0])    
+        cr.line_to(self.padding_left, self.staff.staff_lines_pos[-1])
+        cr.move_to(self.padding_left+3, self.staff.staff_lines_pos[0])
+        cr.line_to(self.padding_left+3, self.staff.staff_lines_pos[-1])
+        cr.stroke()
+        cr.end()
         self.padding_left += 5
 
     def draw_measure_stop(self):
-        if not self.simulate:
-            cr = self.staff.score.cr
-            cr.set_source_rgb(0, 0, 0)
-            cr.set_line_width(1.0)
-            left = self.staff.score.padding_left+(self.index+1)*self.width
-            cr.move_to(left, self.staff.staff_lines_pos[0])
-            cr.line_to(left, self.staff.staff_lines_pos[-1]) 
-            cr.stroke()
+        cr = self.staff.score.cr
+        left = self.staff.score.padding_left+(self.index+1)*self.width
+        self.begin_barline(left)
+        cr.set_source_rgb(0, 0, 0)
+        cr.set_line_width(1.0)
+        cr.move_to(left, self.staff.staff_lines_pos[0])
+        cr.line_to(left, self.staff.staff_lines_pos[-1]) 
+        cr.stroke()
+        cr.end()
         
     def draw_measure_stop_double(self):
-        if not self.simulate:
-            cr = self.staff.score.cr
-            cr.set_source_rgb(0, 0, 0)
-            cr.set_line_width(1.0)
-            left = self.staff.score.padding_left+(self.index+1)*self.width
-            cr.move_to(left-3, self.staff.staff_lines_pos[0])
-            cr.line_to(left-3, self.staff.staff_lines_pos[-1])
-            cr.move_to(left, self.staff.staff_lines_pos[0])
-            cr.line_to(left, self.staff.staff_lines_pos[-1])
-            cr.stroke()
+        cr = self.staff.score.cr
+        left = self.staff.score.padding_left+(self.index+1)*self.width
+        self.begin_barline(left-3).width = 3
+        cr.set_source_rgb(0, 0, 0)
+        cr.set_line_width(1.0)
+        cr.move_to(left-3, self.staff.staff_lines_pos[0])
+        cr.line_to(left-3, self.staff.staff_lines_pos[-1])
+        cr.move_to(left, self.staff.staff_lines_pos[0])
+        cr.line_to(left, self.staff.staff_lines_pos[-1])
+        cr.stroke()
+        cr.end()
         
     def draw_measure_stop_final(self):
-        if not self.simulate:
-            cr = self.staff.score.cr
-            cr.set_source_rgb(0, 0, 0)
-            cr.set_line_width(1.0)
-            left = self.staff.score.padding_left+(self.index+1)*self.width
-            cr.move_to(left-4, self.staff.staff_lines_pos[0])
-            cr.line_to(left-4, self.staff.staff_lines_pos[-1])
-            cr.stroke()
-            cr.set_line_width(3.0)
-            cr.move_to(left, self.staff.staff_lines_pos[0])
-            cr.line_to(left, self.staff.staff_lines_pos[-1])
-            cr.stroke()
+        cr = self.staff.score.cr
+        left = self.staff.score.padding_left+(self.index+1)*self.width
+        self.begin_barline(left-4).width = 4
+        cr.set_source_rgb(0, 0, 0)
+        cr.set_line_width(1.0)
+        cr.move_to(left-4, self.staff.staff_lines_pos[0])
+        cr.line_to(left-4, self.staff.staff_lines_pos[-1])
+        cr.stroke()
+        cr.set_line_width(3.0)
+        cr.move_to(left, self.staff.staff_lines_pos[0])
+        cr.line_to(left, self.staff.staff_lines_pos[-1])
+        cr.stroke()
+        cr.end()
 
     def draw_start_repeat(self):
         cr = self.staff.score.cr
+        node = self.begin_barline(self.padding_left)
         cr.set_font_face(self.staff.score.face_jazz)
         cr.set_source_rgb(0, 0, 0)
         cr.set_font_size(32)
         cr.move_to(self.padding_left-2, self.staff.staff_lines_pos[2])
         text = u'Ú'
-        if not self.simulate:
-            cr.show_text(text)
-        xbear, ybear, fwidth, fheight, xadv, yadv = cr.text_extents(text)
+        cr.show_text(text)
+        xbear, ybear, fwidth, fheight, xadv, yadv = self.text_extents(
+            self.staff.score.face_jazz, 32, text)
+        node.width = fwidth
+        cr.end()
         self.padding_left += fwidth + 2
 
     def draw_stop_repeat(self):
         cr = self.staff.score.cr
+        left = self.staff.score.padding_left+(self.index+1)*self.width
+        self.begin_barline(left)
         cr.set_font_face(self.staff.score.face_jazz)
         cr.set_source_rgb(0, 0, 0)
         cr.set_font_size(32)
-        left = self.staff.score.padding_left+(self.index+1)*self.width
         cr.move_to(left+2, self.staff.staff_lines_pos[2])
         text = u'Ú'
         cr.rotate(math.pi)
-        if not self.simulate:
-            cr.show_text(text)
+        cr.show_text(text)
         cr.rotate(-math.pi)
+        cr.end()
 
     ending_padding_bottom = 10
     ending_padding_top = 0
     def draw_ending(self):
         cr = self.staff.score.cr
+        node = cr.begin('ending', self)
         cr.set_source_rgb(0, 0, 0)
         cr.set_line_width(1.0)
         left = self.staff.score.padding_left+self.index*self.width
         if self.ending:
             cr.set_font_face(self.staff.score.face_jazz)
             cr.set_font_size(22)
-            xbear, ybear, fwidth, fheight, xadv, yadv = cr.text_extents(self.ending)
+            xbear, ybear, fwidth, fheight, xadv, yadv = self.text_extents(
+                self.staff.score.face_jazz, 22, self.ending)
         else:
             fheight = 0
-        top = self.staff.staff_lines_pos[0] - self.top_height - \
-                self.ending_padding_top - fheight - 10
-        cr.move_to(left, self.staff.staff_lines_pos[0]-self.ending_padding_bottom)
-        if not self.simulate:
-            cr.line_to(left, top)
-            cr.line_to(left+self.width*0.9, top)
-            cr.stroke()
+        top_height = self.get_measure_height(left, left+self.width*0.9) + \
+            self.ending_padding_top + fheight + 10
+        top = self.staff.staff_lines_pos[0] - top_height
+        bottom = self.staff.staff_lines_pos[0]-self.ending_padding_bottom
+        cr.move_to(left, bottom)
+        cr.line_to(left, top)
+        cr.line_to(left+self.width*0.9, top)
+        cr.stroke()
         if self.ending != 'empty':
             cr.move_to(left+2, top+fheight-4)
-            if not self.simulate:
-                cr.show_text(self.ending)
-        self.top_height += self.ending_padding_top + fheight + 10
+            cr.show_text(self.ending)
+        node.set_box(left, top, self.width*0.9, bottom-top)
+        cr.end()
+        self.top_height = max(self.top_height, top_height)
+        self.skyline.add(left, self.width*0.9, top_height)
 
     section_table = {
             'A': u'Ø', 'B': u'Ù', 'C': u'Ú', 'D': u'Û', 'E': u'Ü', 'F': u'Ý', 
@@ -333,24 +533,28 @@ class Measure:
     section_padding_bottom = 4
     def draw_section(self):
         cr = self.staff.score.cr
+        node = cr.begin('section', self)
         cr.set_font_face(self.staff.score.face_jazztext)
         cr.set_source_rgb(0, 0, 0)
         cr.set_font_size(25)
         text = self.section_table.get(self.section)
-        xbear, ybear, fwidth, fheight, xadv, yadv = cr.text_extents(text)
+        xbear, ybear, fwidth, fheight, xadv, yadv = self.text_extents(
+            self.staff.score.face_jazztext, 25, text)
         left = self.staff.score.padding_left+self.index*self.width
         top = self.staff.staff_lines_pos[0] - self.top_height - (fheight+ybear) - \
             self.section_padding_bottom
         cr.move_to(left, top)
-        if not self.simulate:
-            cr.show_text(text)
+        cr.show_text(text)
+        node.set_box(left, top+ybear, fwidth, fheight)
+        cr.end()
         self.top_height += fheight + self.section_padding_bottom
         self.chords_left = left + fwidth + 8
         self.chords_padding_left = fwidth + 8
-        self.top_heights.append((left, fwidth, fheight + self.section_padding_bottom))
+        self.skyline.add(left, fwidth, self.top_height)
 
     def draw_time_signature(self):
         cr = self.staff.score.cr
+        node = cr.begin('time', self)
         cr.set_font_face(self.staff.score.face_jazztext)
         cr.set_source_rgb(0, 0, 0)
         cr.set_font_size(22)
@@ -358,8 +562,11 @@ class Measure:
         #
         num = str(self.time[0])
         den = str(self.time[1])
-        xbear, ybear, num_width, fheight, xadv, yadv = cr.text_extents(num)
-        xbear, ybear, den_width, fheight, xadv, yadv = cr.text_extents(den)
+        face = self.staff.score.face_jazztext
+        xbear, ybear, num_width, fheight, xadv, yadv = self.text_extents(
+            face, 22, num)
+        xbear, ybear, den_width, fheight, xadv, yadv = self.text_extents(
+            face, 22, den)
         if num_width > den_width:
             num_padding = 0
             den_padding = (num_width-den_width)*0.5
@@ -368,45 +575,41 @@ class Measure:
             num_padding = (den_width-num_width)*0.5 
         # draw num
         cr.move_to(self.padding_left+num_padding, self.staff.staff_lines_pos[2])
-        if not self.simulate:
-            cr.show_text(num)
+        cr.show_text(num)
         # draw den
         cr.move_to(self.padding_left+den_padding, self.staff.staff_lines_pos[-1])
-        if not self.simulate:
-            cr.show_text(den)
+        cr.show_text(den)
+        node.set_box(self.padding_left, self.staff.staff_lines_pos[0],
+            max(num_width, den_width), self.height)
+        cr.end()
         # update padding left
         self.padding_left += max(num_width, den_width) + 2
     
     def get_note_y(self, note):
-        d = self.staff.lines_distance
-        return {
-            'G5': self.staff.staff_lines_pos[0]-d/2,
-            'F5': self.staff.staff_lines_pos[0],
-            'E5': self.staff.staff_lines_pos[0]+d/2.,
-            'D5': self.staff.staff_lines_pos[1],
-            'C5': self.staff.staff_lines_pos[1]+d/2.,
-            'B4': self.staff.staff_lines_pos[2],
-            'A4': self.staff.staff_lines_pos[2]+d/2.,
-            'G4': self.staff.staff_lines_pos[3],
-            'F4': self.staff.staff_lines_pos[3]+d/2,
-        }[note]
+        return self.staff.staff_lines_pos[0] + \
+            note_offsets(self.staff.lines_distance)[note]
 
     def draw_key_signature(self):
         cr = self.staff.score.cr
+        node = cr.begin('key', self)
         cr.set_font_face(self.staff.score.face_jazz)
         cr.set_source_rgb(0, 0, 0)
         cr.set_font_size(25)
         key, mode = self.key_signature
         top_height = 0
         left = self.padding_left
-        for note in self.key_signatures[key][mode]:
-            top = self.get_note_y(note[:2])
+        for offset, accidental in key_signature_offsets(key, mode,
+                self.staff.lines_distance):
+            top = self.staff.staff_lines_pos[0] + offset
             cr.move_to(self.padding_left, top)
-            xbear, ybear, width, fheight, xadv, yadv = cr.text_extents(note[2])
+            xbear, ybear, width, fheight, xadv, yadv = self.text_extents(
+                self.staff.score.face_jazz, 25, accidental)
             top_height = max(top_height, self.staff.staff_lines_pos[0] - top - ybear)
-            if not self.simulate:
-                cr.show_text(note[2])
+            cr.show_text(accidental)
             self.padding_left += 6
         self.padding_left += 6
+        node.set_box(left, self.staff.staff_lines_pos[0] - top_height,
+            self.padding_left - left, top_height + self.height)
+        cr.end()
         self.top_height = max(self.top_height, top_height)
-        self.top_heights.append((left, self.padding_left, top_height))
+        self.skyline.add(left, self.padding_left - left, top_height)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright (C) 2010 Vittorio Palmisano <vpalmisano at gmail dot com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+import threading
+from collections import OrderedDict
+
+class TextMetrics:
+    """Bounded LRU cache of text extents keyed by (font face, size, text).
+
+    The extents are measured in the unrotated user space of the context
+    passed on a miss; the font state of the context is left untouched.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return '<TextMetrics %d/%d entries, %d hits, %d misses>' %(
+            len(self.cache), self.maxsize, self.hits, self.misses)
+
+    def get(self, key):
+        with self.lock:
+            value = self.cache.pop(key, None)
+            if value is not None:
+                self.cache[key] = value
+                self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.misses += 1
+            self.cache[key] = value
+            if len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+
+    def text_extents(self, cr, face, size, text):
+        key = (face, size, text)
+        extents = self.get(key)
+        if extents is None:
+            cr.save()
+            cr.set_font_face(face)
+            cr.set_font_size(size)
+            extents = cr.text_extents(text)
+            cr.restore()
+            self.set(key, extents)
+        return extents
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.cache),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': total and float(self.hits)/total or 0.0,
+            }
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+class TextGlyphs(TextMetrics):
+    """Bounded LRU cache of the glyphs of a text keyed by (font face,
+    size, text, matrix).
+
+    The glyphs are (index, x, y) tuples relative to the origin of the
+    text, followed by its advance; ``matrix`` is the linear part of the
+    transformation of the context, which the hinting depends on.
+    """
+
+    def glyphs(self, cr, face, size, text, matrix):
+        key = (face, size, text, matrix)
+        glyphs = self.get(key)
+        if glyphs is None:
+            cr.save()
+            cr.set_font_face(face)
+            cr.set_font_size(size)
+            font = cr.get_scaled_font()
+            xbear, ybear, width, height, xadv, yadv = font.text_extents(text)
+            glyphs = (tuple((g[0], g[1], g[2])
+                for g in font.text_to_glyphs(0, 0, text, False)), xadv, yadv)
+            cr.restore()
+            self.set(key, glyphs)
+        return glyphs
+
+text_metrics = TextMetrics()
+text_glyphs = TextGlyphs()
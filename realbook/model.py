@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright (C) 2010 Vittorio Palmisano <vpalmisano at gmail dot com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+"""Drawing-free model of a song, filled by the parsers.
+
+A Song is a flat list of SongMeasures, each tagged with the line (staff)
+it belongs to; sections() and lines() group them. Nothing here needs
+cairo or the fonts: MusicScore.load_song() turns a Song into the
+drawable Staff/Measure/Chord tree when it has to be rendered.
+"""
+import zlib
+import marshal
+from chord import parse_chord, ChordError
+
+class ChordSlot(object):
+    __slots__ = ('index', 'chord', 'symbol', 'small', 'alternate', 'fermata')
+
+    def __init__(self, index, chord='', small=False, alternate=False,
+                 fermata=False):
+        self.index = index
+        self.chord = chord
+        self.symbol = None
+        self.small = small
+        self.alternate = alternate
+        self.fermata = fermata
+
+    def normalize(self):
+        """Parses the chord text into its (interned) ChordSymbol."""
+        self.symbol = parse_chord(self.chord)
+        return self.symbol
+
+    def __repr__(self):
+        return '<ChordSlot: %s index: %d>' %(self.chord, self.index)
+
+class SymbolSlot(object):
+    __slots__ = ('index', 'symbol')
+
+    def __init__(self, index, symbol=''):
+        self.index = index
+        self.symbol = symbol
+
+    def __repr__(self):
+        return '<SymbolSlot: %s index: %d>' %(self.symbol, self.index)
+
+class SongMeasure(object):
+    __slots__ = ('index', 'line', 'time', 'key_signature', 'start_barline',
+                 'stop_barline', 'ending', 'section', 'empty', 'chords',
+                 'symbols')
+
+    def __init__(self, index=0, line=0, time=(), key_signature=(),
+                 start_barline='single', stop_barline='single',
+                 ending='', section='', empty=False):
+        self.index = index
+        self.line = line
+        self.time = time
+        self.key_signature = key_signature
+        self.start_barline = start_barline
+        self.stop_barline = stop_barline
+        self.ending = ending
+        self.section = section
+        self.empty = empty
+        self.chords = []
+        self.symbols = []
+
+    def __repr__(self):
+        return '<SongMeasure %d (line %d)>' %(self.index, self.line)
+
+    def add_chord(self, index, chord='', **kw):
+        c = ChordSlot(index, chord, **kw)
+        self.chords.append(c)
+        return c
+
+    def add_symbol(self, index, symbol=''):
+        s = SymbolSlot(index, symbol)
+        self.symbols.append(s)
+        return s
+
+class Section:
+    def __init__(self, name, measures=None):
+        self.name = name
+        self.measures = measures or []
+
+    def __repr__(self):
+        return '<Section %s (%d measures)>' %(self.name, len(self.measures))
+
+class Song:
+    def __init__(self, title='', author='', tempo='', key=''):
+        self.title = title
+        self.author = author
+        self.tempo = tempo
+        self.key = key
+        self.line = 0
+        self.measures = []
+
+    def __repr__(self):
+        return '<Song %s (%d measures)>' %(self.title, len(self.measures))
+
+    def new_line(self):
+        if self.measures and self.measures[-1].line == self.line:
+            self.line += 1
+        return self.line
+
+    def add_measure(self, **kw):
+        m = SongMeasure(len(self.measures), self.line, **kw)
+        self.measures.append(m)
+        return m
+
+    def lines(self):
+        lines = []
+        for m in self.measures:
+            if not lines or lines[-1][-1].line != m.line:
+                lines.append([])
+            lines[-1].append(m)
+        return lines
+
+    def sections(self):
+        sections = []
+        for m in self.measures:
+            if m.section or not sections:
+                sections.append(Section(m.section))
+            sections[-1].measures.append(m)
+        return sections
+
+    def normalize(self):
+        """Parses every chord once the song is complete.
+
+        Raises chord.ChordError, naming the measure, for unknown chords.
+        """
+        for m, c in self.chords():
+            try:
+                c.normalize()
+            except ChordError, e:
+                raise ChordError('measure %d: %s' %(m.index, e))
+
+    def chords(self):
+        for m in self.measures:
+            for c in m.chords:
+                if c.chord:
+                    yield m, c
+
+# version of the serialized form written by dumps()
+DUMP_VERSION = 1
+
+def dumps(song):
+    """Serializes a Song into a compact byte string."""
+    measures = tuple((m.line, m.time, m.key_signature, m.start_barline,
+            m.stop_barline, m.ending, m.section, m.empty,
+            tuple((c.index, c.chord, c.small, c.alternate, c.fermata)
+                for c in m.chords),
+            tuple((y.index, y.symbol) for y in m.symbols))
+        for m in song.measures)
+    return zlib.compress(marshal.dumps((DUMP_VERSION, song.title, song.author,
+        song.tempo, song.key, song.line, measures)), 1)
+
+def loads(data):
+    """Rebuilds a Song serialized by dumps()."""
+    version, title, author, tempo, key, line, measures = \
+        marshal.loads(zlib.decompress(data))
+    if version != DUMP_VERSION:
+        raise ValueError('unsupported song dump version %r' %version)
+    song = Song(title, author, tempo, key)
+    for (m_line, time, key_signature, start_barline, stop_barline, ending,
+            section, empty, chords, symbols) in measures:
+        song.line = m_line
+        m = song.add_measure(time=time, key_signature=key_signature,
+            start_barline=start_barline, stop_barline=stop_barline,
+            ending=ending, section=section, empty=empty)
+        for index, chord, small, alternate, fermata in chords:
+            m.add_chord(index, chord, small=small, alternate=alternate,
+                fermata=fermata)
+        for index, symbol in symbols:
+            m.add_symbol(index, symbol)
+    song.line = line
+    song.normalize()
+    return song
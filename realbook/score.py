@@ -21,68 +21,181 @@ import cairo
 import ctypes
 import os
 import sys
+import threading
+import time
 from staff import Staff
+from metrics import text_metrics, text_glyphs
+from layout import LayoutNode, LayoutContext, render_glyph_runs, merge_bands
 
 _initialized = False
-def create_cairo_font_face_for_file(filename, faceindex=0, loadoptions=0):
-    class PycairoContext(ctypes.Structure):
-        _fields_ = [("PyObject_HEAD", ctypes.c_byte * object.__basicsize__),
-                ("ctx", ctypes.c_void_p),
-                ("base", ctypes.c_void_p)]
+_lock = threading.RLock()
+# address used as key for the user data attached to the cairo font faces
+_ft_face_key = ctypes.c_int()
+
+class PycairoContext(ctypes.Structure):
+    _fields_ = [("PyObject_HEAD", ctypes.c_byte * object.__basicsize__),
+            ("ctx", ctypes.c_void_p),
+            ("base", ctypes.c_void_p)]
+
+def _init_freetype():
+    global _initialized
     global _freetype_so
     global _cairo_so
     global _ft_lib
     global _surface
-    CAIRO_STATUS_SUCCESS = 0
     FT_Err_Ok = 0
-    if not _initialized:
-        # find shared objects
-        _freetype_so = ctypes.CDLL ("libfreetype.so.6")
-        _cairo_so = ctypes.CDLL ("libcairo.so.2")
-        # initialize freetype
-        _ft_lib = ctypes.c_void_p ()
-        if FT_Err_Ok != _freetype_so.FT_Init_FreeType (ctypes.byref (_ft_lib)):
-            raise "Error initialising FreeType library."
-        _surface = cairo.ImageSurface (cairo.FORMAT_A8, 0, 0)
-    # create freetype face
-    ft_face = ctypes.c_void_p()
-    cairo_ctx = cairo.Context (_surface)
-    cairo_t = PycairoContext.from_address(id(cairo_ctx)).ctx
+    # find shared objects
+    _freetype_so = ctypes.CDLL ("libfreetype.so.6")
+    _cairo_so = ctypes.CDLL ("libcairo.so.2")
+    _freetype_so.FT_New_Face.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+        ctypes.c_long, ctypes.c_void_p]
+    _freetype_so.FT_Done_Face.argtypes = [ctypes.c_void_p]
     _cairo_so.cairo_ft_font_face_create_for_ft_face.restype = ctypes.c_void_p
-    if FT_Err_Ok != _freetype_so.FT_New_Face (_ft_lib, filename, faceindex, ctypes.byref(ft_face)):
-        raise "Error creating FreeType font face for " + filename
-    # create cairo font face for freetype face
-    cr_face = _cairo_so.cairo_ft_font_face_create_for_ft_face (ft_face, loadoptions)
-    if CAIRO_STATUS_SUCCESS != _cairo_so.cairo_font_face_status (cr_face):
-        raise "Error creating cairo font face for " + filename
-    _cairo_so.cairo_set_font_face (cairo_t, cr_face)
-    if CAIRO_STATUS_SUCCESS != _cairo_so.cairo_status (cairo_t):
-        raise "Error creating cairo font face for " + filename
-    face = cairo_ctx.get_font_face()
+    _cairo_so.cairo_ft_font_face_create_for_ft_face.argtypes = [
+        ctypes.c_void_p, ctypes.c_int]
+    _cairo_so.cairo_font_face_status.argtypes = [ctypes.c_void_p]
+    _cairo_so.cairo_font_face_set_user_data.argtypes = [ctypes.c_void_p,
+        ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+    _cairo_so.cairo_font_face_destroy.argtypes = [ctypes.c_void_p]
+    _cairo_so.cairo_set_font_face.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    _cairo_so.cairo_status.argtypes = [ctypes.c_void_p]
+    # initialize freetype
+    _ft_lib = ctypes.c_void_p ()
+    if FT_Err_Ok != _freetype_so.FT_Init_FreeType (ctypes.byref (_ft_lib)):
+        raise RuntimeError("Error initialising FreeType library.")
+    _surface = cairo.ImageSurface (cairo.FORMAT_A8, 0, 0)
+    _initialized = True
+
+def create_cairo_font_face_for_file(filename, faceindex=0, loadoptions=0):
+    CAIRO_STATUS_SUCCESS = 0
+    FT_Err_Ok = 0
+    with _lock:
+        if not _initialized:
+            _init_freetype()
+        # create freetype face
+        ft_face = ctypes.c_void_p()
+        cairo_ctx = cairo.Context (_surface)
+        cairo_t = PycairoContext.from_address(id(cairo_ctx)).ctx
+        if FT_Err_Ok != _freetype_so.FT_New_Face (_ft_lib, filename, faceindex, ctypes.byref(ft_face)):
+            raise RuntimeError("Error creating FreeType font face for " + filename)
+        # create cairo font face for freetype face
+        cr_face = _cairo_so.cairo_ft_font_face_create_for_ft_face (ft_face, loadoptions)
+        if CAIRO_STATUS_SUCCESS != _cairo_so.cairo_font_face_status (cr_face):
+            _freetype_so.FT_Done_Face(ft_face)
+            raise RuntimeError("Error creating cairo font face for " + filename)
+        # the freetype face is released by cairo together with the font face
+        done_face = ctypes.cast(_freetype_so.FT_Done_Face, ctypes.c_void_p)
+        if CAIRO_STATUS_SUCCESS != _cairo_so.cairo_font_face_set_user_data (
+                cr_face, ctypes.byref(_ft_face_key), ft_face, done_face):
+            _cairo_so.cairo_font_face_destroy(cr_face)
+            _freetype_so.FT_Done_Face(ft_face)
+            raise RuntimeError("Error creating cairo font face for " + filename)
+        _cairo_so.cairo_set_font_face (cairo_t, cr_face)
+        # the context (and the python wrapper) keeps its own reference
+        _cairo_so.cairo_font_face_destroy(cr_face)
+        if CAIRO_STATUS_SUCCESS != _cairo_so.cairo_status (cairo_t):
+            raise RuntimeError("Error creating cairo font face for " + filename)
+        face = cairo_ctx.get_font_face()
     return face
 
+class FontRegistry:
+    """Process-wide cache of the cairo font faces used by the scores.
+
+    Every ttf file is opened with FreeType only the first time it is
+    requested; the resulting faces are shared by all the MusicScore
+    instances (and threads) of the process. A face (and its FreeType
+    handle) is released when the registry is cleared and no score is
+    using it anymore.
+    """
+    fonts = ('Jazz', 'JazzText', 'JazzCord', 'JazzPerc')
+
+    def __init__(self, ttf_dir=None):
+        if ttf_dir is None:
+            d = os.path.dirname(os.path.abspath(__file__))
+            ttf_dir = os.path.join(d, '..', 'ttf')
+        self.ttf_dir = ttf_dir
+        self.faces = {}
+
+    def __repr__(self):
+        return '<FontRegistry %s (%d faces)>' %(self.ttf_dir, len(self.faces))
+
+    def path(self, name):
+        return os.path.join(self.ttf_dir, name + '.ttf')
+
+    def get(self, name):
+        face = self.faces.get(name)
+        if face is not None:
+            return face
+        with _lock:
+            face = self.faces.get(name)
+            if face is None:
+                face = create_cairo_font_face_for_file(self.path(name), 0)
+                self.faces[name] = face
+        return face
+
+    def preload(self, names=None):
+        for name in names or self.fonts:
+            self.get(name)
+
+    def set_ttf_dir(self, ttf_dir):
+        with _lock:
+            self.ttf_dir = ttf_dir
+            self.clear()
+
+    def clear(self):
+        with _lock:
+            self.faces = {}
+
+font_registry = FontRegistry()
+
+def preload_fonts(names=None, ttf_dir=None):
+    if ttf_dir is not None:
+        font_registry.set_ttf_dir(ttf_dir)
+    font_registry.preload(names)
+    return font_registry
+
 class MusicScore:
     padding_left = 20
     padding_right = 20
     padding_top = 20
     padding_bottom = 20
     score_padding = 10
+    stats = None
+    # lay out the measures with equal content once
+    memoize_measures = True
+    # draw the text of each staff as runs of glyphs, where pycairo can
+    # convert text to glyphs
+    glyph_runs = hasattr(getattr(cairo, 'ScaledFont', None), 'text_to_glyphs')
 
-    def __init__(self):
-        d = os.path.dirname(os.path.abspath(__file__))
-        ttf_dir = os.path.join(d, '..', 'ttf')
-        self.face_jazztext = create_cairo_font_face_for_file(
-            os.path.join(ttf_dir, 'JazzText.ttf'), 0)
-        self.face_jazz = create_cairo_font_face_for_file(
-            os.path.join(ttf_dir, 'Jazz.ttf'), 0)
-        self.face_jazzcord = create_cairo_font_face_for_file(
-            os.path.join(ttf_dir, 'JazzCord.ttf'), 0)
+    def __init__(self, fonts=None, metrics=None, stats=None,
+                 layout_cache=None):
+        """``stats`` is an optional realbook.stats.RenderStats collecting
+        the timings of the layout and rendering; ``layout_cache`` is an
+        optional realbook.layout.LayoutCache of measure layouts shared
+        with other scores."""
+        self.fonts = fonts or font_registry
+        self.metrics = metrics or text_metrics
+        self.glyphs = text_glyphs
+        self.stats = stats
+        self.layout_cache = layout_cache
+        if stats is not None:
+            t = time.time()
+        self.face_jazztext = self.fonts.get('JazzText')
+        self.face_jazz = self.fonts.get('Jazz')
+        self.face_jazzcord = self.fonts.get('JazzCord')
+        if stats is not None:
+            stats.add('fonts', time.time() - t)
         #
         self.title = ''
         self.author = ''
         self.tempo = ''
         self.key = ''
         self.staffs = []
+        self.cr = self.measure_cr = None
+        self.measure_layouts = None
+        # the last layout, see relayout()
+        self.root = None
+        self.head_bottom = 0
         
     def add_staff(self, *args, **kw):
         if not kw.get('index'):
@@ -91,25 +204,289 @@ class MusicScore:
         self.staffs.append(s)
         return s
 
+    def load_song(self, song):
+        """Builds the staffs of the score from a realbook.model.Song."""
+        self.title = song.title
+        self.author = song.author
+        self.tempo = song.tempo
+        self.key = song.key
+        for line in song.lines():
+            staff = self.add_staff()
+            for m in line:
+                measure = staff.add_measure(time=m.time,
+                    key_signature=m.key_signature,
+                    start_barline=m.start_barline, stop_barline=m.stop_barline,
+                    ending=m.ending, section=m.section, empty=m.empty)
+                for c in m.chords:
+                    measure.add_chord(c.index, c.chord, small=c.small,
+                        alternate=c.alternate, fermata=c.fermata,
+                        symbol=c.symbol)
+                for y in m.symbols:
+                    measure.add_symbol(y.index, y.symbol)
+        return self
+
+    def text_extents(self, face, size, text):
+        if self.stats is not None:
+            self.stats.count('text_extents')
+        return self.metrics.text_extents(self.measure_cr, face, size, text)
+
+    def layout(self, width, height, dpi=100, cr=None):
+        """Compute the geometry of the score once.
+
+        The returned LayoutNode tree can be inspected and rendered on any
+        number of cairo contexts; ``cr``, when given, is only used to
+        measure the text.
+        """
+        stats = self.stats
+        if stats is not None:
+            t = time.time()
+        self.width, self.height, self.dpi = width, height, dpi
+        if cr is None:
+            cr = cairo.Context(cairo.ImageSurface(cairo.FORMAT_A8, 0, 0))
+        self.measure_cr = cr
+        if self.memoize_measures:
+            # the measures laid out by this layout, see Measure.draw
+            self.measure_layouts = {}
+        root = LayoutNode('score', self)
+        root.set_box(0, 0, width, height)
+        self.cr = LayoutContext(root)
+        try:
+            # background
+            self.cr.set_source_rgb(1.0, 1.0, 1.0)
+            self.cr.rectangle(0, 0, width, height)
+            self.cr.fill()
+            #
+            if stats is not None:
+                h = time.time()
+            top = self.head_bottom = self.draw_head()
+            if stats is not None:
+                stats.add('head', time.time() - h)
+            for staff in self.staffs:
+                top = staff.draw(top + self.score_padding)
+        finally:
+            self.cr = self.measure_cr = None
+            self.measure_layouts = None
+        self.root = root
+        if stats is not None:
+            stats.add('layout', time.time() - t)
+        return root
+
+    def relayout(self, width, height, dpi=100, cr=None):
+        """Updates the last layout after the score was edited.
+
+        Only the staffs marked dirty by the changes of their measures,
+        chords and symbols are laid out again, reusing the layout of
+        their unchanged measures; the staffs below are moved by the
+        change of height. Returns the layout and the damaged rectangles
+        (x, y, width, height) of the page, the only part to repaint.
+        Without a previous layout of the same size the whole score is
+        laid out and damaged.
+        """
+        root = self.root
+        if root is None or (width, height, dpi) != \
+                (self.width, self.height, self.dpi):
+            return self.layout(width, height, dpi, cr), \
+                [(0, 0, width, height)]
+        stats = self.stats
+        if stats is not None:
+            t = time.time()
+        if cr is None:
+            cr = cairo.Context(cairo.ImageSurface(cairo.FORMAT_A8, 0, 0))
+        self.measure_cr = cr
+        if self.memoize_measures:
+            self.measure_layouts = {}
+        bands = []
+        try:
+            top = self.head_bottom
+            for staff in self.staffs:
+                top += self.score_padding
+                old = staff.node
+                if old is not None:
+                    old_band = (staff.top, staff.bottom)
+                if staff.dirty or old is None:
+                    self.cr = LayoutContext(LayoutNode('score', self))
+                    staff.redraw(top)
+                    if old is None:
+                        root.add(staff.node)
+                    else:
+                        i = root.ops.index(old)
+                        root.ops[i] = staff.node
+                        root.children[root.children.index(old)] = staff.node
+                elif staff.top != top:
+                    staff.shift(top - staff.top)
+                else:
+                    top = staff.bottom
+                    continue
+                if old is not None:
+                    bands.append(old_band)
+                bands.append((staff.top, staff.bottom))
+                top = staff.bottom
+        finally:
+            self.cr = self.measure_cr = None
+            self.measure_layouts = None
+        if stats is not None:
+            stats.add('layout', time.time() - t)
+        return root, [(0, top, width, bottom - top)
+            for top, bottom in merge_bands(bands)]
+
+    def begin_page(self, number):
+        """Starts the LayoutNode of a page with its background and head;
+        returns it with the bottom of the head."""
+        page = LayoutNode('page', self)
+        page.set_box(0, 0, self.width, self.height)
+        self.cr = LayoutContext(page)
+        self.cr.set_source_rgb(1.0, 1.0, 1.0)
+        self.cr.rectangle(0, 0, self.width, self.height)
+        self.cr.fill()
+        if number == 1:
+            return page, self.draw_head()
+        return page, self.draw_running_head(number)
+
+    def pages(self, width, height, dpi=100, cr=None):
+        """Lays out the score one page at a time.
+
+        Yields a LayoutNode for each page of ``height``: the first starts
+        with the head of the score, the next ones with the title and the
+        page number. A staff that does not fit above the bottom padding
+        goes to the next page, alone if it is taller than a page. Only
+        the page being laid out is kept, so the memory does not grow with
+        the length of the score.
+        """
+        stats = self.stats
+        self.width, self.height, self.dpi = width, height, dpi
+        # the staffs leave the last layout, relayout() starts over
+        self.root = None
+        if cr is None:
+            cr = cairo.Context(cairo.ImageSurface(cairo.FORMAT_A8, 0, 0))
+        bottom = height - self.padding_bottom
+        try:
+            number = 1
+            self.measure_cr = cr
+            if stats is not None:
+                t = time.time()
+            page, top = self.begin_page(number)
+            staffs = []
+            if self.memoize_measures:
+                self.measure_layouts = {}
+            for staff in self.staffs:
+                staff.draw(top + self.score_padding)
+                if staff.bottom > bottom and staffs:
+                    # the staff goes on top of the next page
+                    page.ops.pop()
+                    page.children.pop()
+                    if stats is not None:
+                        stats.add('layout', time.time() - t)
+                    yield page
+                    for s in staffs:
+                        s.node = None
+                    number += 1
+                    self.measure_cr = cr
+                    if stats is not None:
+                        t = time.time()
+                    page, top = self.begin_page(number)
+                    staff.shift(top + self.score_padding - staff.top)
+                    self.cr.add(staff.node)
+                    staffs = []
+                    if self.memoize_measures:
+                        self.measure_layouts = {}
+                staffs.append(staff)
+                top = staff.bottom
+            if stats is not None:
+                stats.add('layout', time.time() - t)
+            yield page
+            for s in staffs:
+                s.node = None
+        finally:
+            self.cr = self.measure_cr = None
+            self.measure_layouts = None
+
+    def draw_pages(self, cr, width, height, dpi=100):
+        """Draws the pages of the score on ``cr``, each followed by
+        show_page; returns the number of pages."""
+        n = 0
+        for page in self.pages(width, height, dpi, cr):
+            self.render(page, cr)
+            cr.show_page()
+            n += 1
+        return n
+
     def draw(self, cr, width, height, dpi=100):
-        self.cr, self.width, self.height, self.dpi = cr, width, height, dpi
-        # background
-        cr.set_source_rgb(1.0, 1.0, 1.0)
-        cr.rectangle(0, 0, width, height)
-        cr.fill()
-        #
-        top = self.draw_head()
-        for staff in self.staffs:
-            top = staff.draw(top + self.score_padding)
+        return self.render(self.layout(width, height, dpi, cr), cr)
+
+    def render(self, layout, cr):
+        """Draws a layout of the score on ``cr``."""
+        stats = self.stats
+        if stats is not None:
+            t = time.time()
+        if self.glyph_runs:
+            runs = render_glyph_runs(layout, cr, self.glyphs)
+        else:
+            runs = 0
+            layout.render(cr)
+        if stats is not None:
+            stats.add('render', time.time() - t)
+            stats.count('show_text', sum(1 for node in layout.walk()
+                for op in node.ops
+                if type(op) is tuple and op[0] == 'show_text'))
+            stats.count('show_glyphs', runs)
+        return layout
+
+    def record(self, width, height, dpi=100):
+        """Draws the score once on a cairo.RecordingSurface.
+
+        The recording can be painted on any number of surfaces of any
+        type and scale (see parser.render.replay), the vector outputs
+        keep it as vectors.
+        """
+        surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA,
+            (0, 0, width, height))
+        self.draw(cairo.Context(surface), width, height, dpi)
+        return surface
+
+    def record_pages(self, width, height, dpi=100):
+        """Draws the pages of the score (see pages()) once, each on its
+        cairo.RecordingSurface; returns the list of the recordings."""
+        recordings = []
+        for page in self.pages(width, height, dpi):
+            surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA,
+                (0, 0, width, height))
+            self.render(page, cairo.Context(surface))
+            recordings.append(surface)
+        return recordings
+
+    def draw_running_head(self, number):
+        """The title and the page number on top of the continuation
+        pages."""
+        cr = self.cr
+        node = cr.begin('head', self)
+        face = self.face_jazztext
+        cr.set_font_face(face)
+        cr.set_source_rgb(0, 0, 0)
+        cr.set_font_size(20)
+        xbear, ybear, fwidth, fheight, xadv, yadv = self.text_extents(
+            face, 20, self.title)
+        top = fheight + self.padding_top
+        cr.move_to(self.padding_left, top)
+        cr.show_text(self.title)
+        text = str(number)
+        xbear, ybear, fwidth, fheight, xadv, yadv = self.text_extents(
+            face, 20, text)
+        cr.move_to(self.width - self.padding_right - fwidth, top)
+        cr.show_text(text)
+        node.set_box(0, 0, self.width, top)
+        cr.end()
+        return top
 
     def draw_head(self):
         cr = self.cr
+        node = cr.begin('head', self)
         cr.set_font_face(self.face_jazztext)
         cr.set_source_rgb(0, 0, 0)
         # title
         text = self.title
         cr.set_font_size(40)
-        xbear, ybear, fwidth, fheight, xadv, yadv = cr.text_extents(text)
+        xbear, ybear, fwidth, fheight, xadv, yadv = self.text_extents(
+            self.face_jazztext, 40, text)
         top = fheight + self.padding_top
         cr.move_to((self.width-fwidth)/2, top)
         cr.show_text(text)
@@ -117,21 +494,23 @@ class MusicScore:
         # author
         text = self.author
         cr.set_font_size(20)
-        xbear, ybear, fwidth, fheight, xadv, yadv = cr.text_extents(text)
+        xbear, ybear, fwidth, fheight, xadv, yadv = self.text_extents(
+            self.face_jazztext, 20, text)
         top += fheight
         cr.move_to((self.width-self.padding_left-self.padding_right-fwidth), top)
         cr.show_text(text)
         # tempo
         text = self.tempo
         cr.set_font_size(20)
-        xbear, ybear, fwidth, fheight, xadv, yadv = cr.text_extents(text)
+        xbear, ybear, fwidth, fheight, xadv, yadv = self.text_extents(
+            self.face_jazztext, 20, text)
         cr.move_to(self.padding_left, top)
         cr.show_text(text)
-    
-
+        node.set_box(0, 0, self.width, top)
+        cr.end()
         return top
 
-def test():
+def test_score():
     self = MusicScore()
     #
     s = self.add_staff()
@@ -211,8 +590,10 @@ def test():
     m.add_chord(1, 'Eb7alt')
     m.add_chord(2, 'C#7alt', fermata=True)
     m.add_chord(1, 'C7b9b13', alternate=True, fermata=True)
+    return self
 
-    #
+def test():
+    self = test_score()
     w, h = (8.27*100, 11.69*100)
     surface = cairo.PDFSurface('score.pdf', w, h)
     cr = cairo.Context(surface)
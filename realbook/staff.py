@@ -17,52 +17,105 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 #
+import time
 from measure import Measure
+from layout import content_property
 
-class Staff:
+class Staff(object):
+    # musical content, then drawing state set by reset_drawing()
+    __slots__ = ('score', '_index', 'measures', 'dirty',
+                 'top', 'top_height', 'bottom', 'staff_lines_pos', 'node')
     lines_distance = 8
 
     def __init__(self, score, index):
         self.score = score
-        self.index = index
+        self._index = index
         self.measures = []
+        self.dirty = True
+        self.node = None
 
     def __repr__(self):
         return '<Staff %d (%d measures)>' %(self.index, len(self.measures))
 
+    index = content_property('index')
+
+    def touch(self):
+        """Marks the staff dirty; call it after changing the measures list
+        in place."""
+        self.dirty = True
+
     def add_measure(self, *args, **kw):
         if not kw.get('index'):
             kw['index'] = len(self.measures)
         m = Measure(self, *args, **kw)
         self.measures.append(m)
+        self.touch()
         return m
             
     def reset_drawing(self): 
+        self.dirty = False
         self.top = 0
         self.top_height = 0
 
     def draw(self, top):
+        stats = self.score.stats
+        if stats is not None:
+            t = time.time()
         self.reset_drawing()
         cr = self.score.cr
-        # draw lines
-        cr.save()
+        node = cr.begin('staff', self)
         self.top = top
         self.staff_lines_pos = []
         for i in xrange(5):
             self.staff_lines_pos.append(top+i*self.lines_distance)
-        # draw measures
-        width = (self.score.width-self.score.padding_right-self.score.padding_left) \
-                    / float(len(self.measures))
-        self.top_height, max_height = 0, 0
+        # lay out measures
+        width = self.measures_width()
+        self.top_height, max_height, bottom = 0, 0, 0
         for measure in self.measures:
-            measure.draw(width, simulate=True)
+            measure.draw(width)
             self.top_height = max(self.top_height, measure.top_height)
             max_height = max(max_height, measure.total_height())
-        #
-        cr.restore()
-        cr.translate(0, self.top_height)
-        for measure in self.measures:
-            measure.draw(width)
-        cr.translate(0, -self.top_height)
-        return self.top + max_height
+            bottom = max(bottom, measure.height + measure.bottom_height)
+        # the measures are drawn below their chords and symbols
+        node.dy = self.top_height
+        node.set_box(self.score.padding_left, top,
+            width*len(self.measures), self.top_height + bottom)
+        cr.end()
+        self.node = node
+        self.bottom = self.top + max_height
+        if stats is not None:
+            stats.add('staff', time.time() - t)
+        return self.bottom
+
+    def measures_width(self):
+        return (self.score.width-self.score.padding_right-self.score.padding_left) \
+                    / float(len(self.measures))
 
+    def redraw(self, top):
+        """Lays out the staff again at ``top``, reusing the layout of the
+        measures that did not change since the last one."""
+        layouts = self.score.measure_layouts
+        if layouts is not None and self.node is not None:
+            width = self.measures_width()
+            for node in self.node.children:
+                m = node.obj
+                if m.dirty or m.staff is not self or m.width != width:
+                    continue
+                layouts[m.signature(width)] = (m, node,
+                    self.score.padding_left + m.index*width, self.top,
+                    m.drawing_state())
+        return self.draw(top)
+
+    def shift(self, dy):
+        """Moves the laid out staff down by ``dy``."""
+        self.top += dy
+        self.bottom += dy
+        self.staff_lines_pos = [y + dy for y in self.staff_lines_pos]
+        self.node.y += dy
+        # the measures are moved, the staff keeps its offset
+        for node in self.node.children:
+            node.y += dy
+            node.dy += dy
+        for measure in self.measures:
+            for item in measure.chords + measure.symbols:
+                item.top += dy
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright (C) 2010 Vittorio Palmisano <vpalmisano at gmail dot com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+import sys
+
+class RenderStats:
+    """Timings and counters of the rendering of one song.
+
+    A RenderStats is passed to the parser and to MusicScore, which keeps
+    it in ``score.stats``; the instrumented methods only test that
+    attribute when it is None. The phases are:
+
+        fonts       loading of the font faces by MusicScore
+        parse       irealbook:// string to Song
+        layout      MusicScore.layout, including the nested phases
+        head        title, author and tempo
+        staff       Staff.draw, including its measures
+        measure     Measure.draw, including its chords
+        chord       Chord.draw of the non empty chords
+        render      replay of the layout on the cairo context
+        write       show_page and finish of the pdf, write_to_png
+
+    ``times`` holds the wall time of each phase in seconds and ``calls``
+    how many times it ran; ``counts`` holds the text_extents calls, the
+    texts drawn (show_text), the runs of glyphs they were batched into
+    (show_glyphs) and the measures and chords of the parsed song.
+    ``callback``, when given, is called with the stats by finish().
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.times = {}
+        self.calls = {}
+        self.counts = {}
+
+    def __repr__(self):
+        return '<RenderStats %s>' %', '.join('%s %.2f ms' %(phase, t*1000)
+            for phase, t in sorted(self.times.items()))
+
+    def add(self, phase, seconds):
+        self.times[phase] = self.times.get(phase, 0.0) + seconds
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_song(self, song):
+        self.count('measures', len(song.measures))
+        self.count('chords', sum(1 for c in song.chords()))
+
+    def finish(self):
+        if self.callback is not None:
+            self.callback(self)
+
+    def as_dict(self):
+        return {
+            'times': dict(self.times),
+            'calls': dict(self.calls),
+            'counts': dict(self.counts),
+        }
+
+    def report(self, out=sys.stderr):
+        for phase, t in sorted(self.times.items(), key=lambda i: -i[1]):
+            out.write('%-8s %9.2f ms %6d calls\n' %(phase, t*1000,
+                self.calls[phase]))
+        for name, n in sorted(self.counts.items()):
+            out.write('%-12s %6d\n' %(name, n))
@@ -19,38 +19,58 @@
 #
 import math
 
+from layout import content_property
+
 symbols_table = {
     'n': 'N.C.', 
     '/': '/',
     'coda': u'ó', 'segno': u'ô',
 }
 
-class Symbol:
+class Symbol(object):
+    # musical content, then drawing state set by reset_drawing()
+    __slots__ = ('measure', '_index', '_symbol', 'dirty',
+                 'left', 'top', 'width', 'height')
     padding_bottom = 10
 
     def __init__(self, measure, index, symbol=''):
         self.measure = measure
-        self.index = index
-        self.symbol = symbol
+        self._index = index
+        self._symbol = symbol
+        self.dirty = True
 
     def __repr__(self):
-        return '<Symbol: %s index: %d>' %(self.chord, self.index)
+        return '<Symbol: %s index: %d>' %(self.symbol, self.index)
+
+    index = content_property('index')
+    symbol = content_property('symbol')
+
+    def touch(self):
+        self.dirty = True
+        if self.measure is not None:
+            self.measure.touch()
 
     def reset_drawing(self):
+        self.dirty = False
         self.height = 0
         self.width = 0
         self.top = 0
         self.left = 0
         self.height = 0
 
-    def draw(self, simulate=False):
+    def draw(self):
         self.reset_drawing()
         if not self.symbol:
             return
-        self._draw_symbol(simulate)
+        cr = self.measure.staff.score.cr
+        node = cr.begin('symbol', self)
+        self._draw_symbol()
         self.height += self.padding_bottom
+        node.set_box(self.left, self.measure.staff.staff_lines_pos[0]-self.height,
+            self.width, self.height)
+        cr.end()
 
-    def _draw_symbol(self, simulate=False):
+    def _draw_symbol(self):
         cr = self.measure.staff.score.cr
         # draw symbol
         padding_left = max(self.measure.padding_left, self.measure.chords_left)
@@ -62,26 +82,25 @@ class Symbol:
             right = padding_left + (self.index+1)*(
                 self.measure.width/float(self.measure.num_chords()))
             center = left + (right - left)*0.5
-            if not simulate:
-                if self.symbol == '%':
-                    self._draw_repeat(center, top)
-                elif self.symbol in ('x', 'r'):
-                    self._draw_repeat_double(center, top)
+            if self.symbol == '%':
+                self._draw_repeat(center, top)
+            elif self.symbol in ('x', 'r'):
+                self._draw_repeat_double(center, top)
         else:
             text = symbols_table.get(self.symbol)
             if not text:
                 text = self.symbol
-            cr.set_font_face(self.measure.staff.score.face_jazztext)
+            face = self.measure.staff.score.face_jazztext
+            cr.set_font_face(face)
             cr.set_font_size(25)
-            xbear, ybear, fwidth, fheight, xadv, yadv = cr.text_extents(text)
-            top_height = max(self.measure.get_measure_height(left),
-                self.measure.get_measure_height(left+fwidth))
+            xbear, ybear, fwidth, fheight, xadv, yadv = \
+                self.measure.text_extents(face, 25, text)
+            top_height = self.measure.get_measure_height(left, left+fwidth)
             self.top -= top_height
             cr.move_to(left, self.top)
             self.height = max(self.height, fheight)
             self.width += fwidth + 1
-            if not simulate:
-                cr.show_text(text) 
+            cr.show_text(text)
         self.height += self.padding_bottom + top_height
 
     def _draw_repeat(self, center, top):
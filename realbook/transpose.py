@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright (C) 2010 Vittorio Palmisano <vpalmisano at gmail dot com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+"""Transposition of the parsed songs.
+
+The notes are moved by an interval, a number of letters and of
+semitones, so that a song keeps its spelling relative to the key: the
+bIII of C (Eb) becomes the bIII of A (C), not B#. The notes that
+would need a double accidental, and the E# B# Cb Fb not in the scale
+of the target key, are spelled as in the table of the target key
+instead. The keys are taken from tables holding only keys that Measure
+can draw.
+"""
+from chord import parse_chord
+from model import Song
+from measure import key_signatures
+
+letters = ('C', 'D', 'E', 'F', 'G', 'A', 'B')
+naturals = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+accidentals = {'': 0, '#': 1, 'b': -1}
+
+# spelling of the keys, and of the notes in them, by pitch class
+major_keys = ('C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B')
+minor_keys = ('C', 'C#', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'G#', 'A', 'Bb', 'B')
+flat_notes = ('C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B')
+sharp_notes = ('C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B')
+flat_keys = set(('F', 'Bb', 'Eb', 'Ab', 'Db', 'Gb', 'Cb'))
+flat_minor_keys = set(('D', 'G', 'C', 'F', 'Bb', 'Eb', 'Ab'))
+
+# semitones from concert pitch to the written pitch of the transposing
+# instruments
+transposing_instruments = {
+    'C': 0,
+    'Bb': 2,
+    'Eb': 9,
+    'F': 7,
+}
+
+def pitch(name):
+    """Pitch class of a note like 'Bb'."""
+    return (naturals[name[0]] + accidentals[name[1:]]) % 12
+
+def parse_key(key):
+    """Returns the (name, mode) of an irealbook key like 'Bb' or 'Am'."""
+    name, mode = key[0], 'maj'
+    if len(key) == 2:
+        if key[1] in ('b', '#'):
+            name += key[1]
+        elif key[1] == 'm':
+            mode = 'min'
+    elif len(key) == 3:
+        if key[1] in ('b', '#'):
+            name += key[1]
+        if key[2] == 'm':
+            mode = 'min'
+    return (name, mode)
+
+def key_name(key):
+    """The irealbook name of a (name, mode) key."""
+    name, mode = key
+    return mode == 'min' and name + 'm' or name
+
+def transpose_key(key, semitones):
+    """The (name, mode) key ``semitones`` above ``key``; a key moved by
+    octaves keeps its spelling, F# staying F#."""
+    if not semitones % 12:
+        return key
+    name, mode = key
+    keys = mode == 'min' and minor_keys or major_keys
+    return (keys[(pitch(name) + semitones) % 12], mode)
+
+_transposers = {}
+
+class Transposer:
+    """Moves the notes from the key ``source`` to the key ``target``,
+    both (name, mode) tuples; see transposer()."""
+
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.semitones = (pitch(target[0]) - pitch(source[0])) % 12
+        self.letters = (letters.index(target[0][0]) -
+            letters.index(source[0][0])) % 7
+        name, mode = target
+        if mode == 'min':
+            flats = name in flat_minor_keys
+        else:
+            flats = name in flat_keys
+        self.notes = flats and flat_notes or sharp_notes
+        self.scale = set((note[0], note[2]) for note in key_signatures[name][mode])
+        self.spellings = {}
+        self.chords = {}
+
+    def __repr__(self):
+        return '<Transposer %s to %s>' %(key_name(self.source),
+            key_name(self.target))
+
+    def note(self, letter, accidental=''):
+        """Returns the (letter, accidental) of a transposed note."""
+        spelling = self.spellings.get((letter, accidental))
+        if spelling is None:
+            new_letter = letters[(letters.index(letter) + self.letters) % 7]
+            new_pitch = (naturals[letter] + accidentals[accidental] +
+                self.semitones) % 12
+            offset = (new_pitch - naturals[new_letter]) % 12
+            if offset == 0:
+                spelling = (new_letter, '')
+            elif offset == 1:
+                spelling = (new_letter, '#')
+            elif offset == 11:
+                spelling = (new_letter, 'b')
+            if spelling is None or (spelling[0] + spelling[1] in
+                    ('E#', 'B#', 'Cb', 'Fb') and spelling not in self.scale):
+                note = self.notes[new_pitch]
+                spelling = (note[0], note[1:])
+            self.spellings[(letter, accidental)] = spelling
+        return spelling
+
+    def chord(self, symbol):
+        """Returns the transposed ChordSymbol of ``symbol``."""
+        if symbol is None:
+            return None
+        chord = self.chords.get(symbol.text)
+        if chord is None:
+            text = ''.join(self.note(symbol.root, symbol.accidental)) + \
+                symbol.quality
+            if symbol.bass_root:
+                text += '/' + ''.join(self.note(symbol.bass_root,
+                    symbol.bass_accidental))
+            chord = self.chords[symbol.text] = parse_chord(text)
+        return chord
+
+    def song(self, song):
+        """Returns a transposed copy of ``song``.
+
+        The copy has the same lines, measures and symbols; only the chords,
+        the key signatures and the key change.
+        """
+        copy = Song(song.title, song.author, song.tempo,
+            key_name(self.target))
+        for m in song.measures:
+            copy.line = m.line
+            key_signature = m.key_signature
+            if key_signature:
+                key_signature = transpose_key(key_signature, self.semitones)
+            measure = copy.add_measure(time=m.time,
+                key_signature=key_signature, start_barline=m.start_barline,
+                stop_barline=m.stop_barline, ending=m.ending,
+                section=m.section, empty=m.empty)
+            for c in m.chords:
+                symbol = self.chord(c.symbol)
+                chord = measure.add_chord(c.index, symbol and symbol.text or '',
+                    small=c.small, alternate=c.alternate, fermata=c.fermata)
+                chord.symbol = symbol
+            measure.symbols = list(m.symbols)
+        copy.line = song.line
+        return copy
+
+def transposer(source, target):
+    """The shared Transposer from the key ``source`` to ``target``."""
+    t = _transposers.get((source, target))
+    if t is None:
+        t = _transposers[(source, target)] = Transposer(source, target)
+    return t
+
+def song_key(song):
+    return song.key and parse_key(song.key) or ('C', 'maj')
+
+def transpose(song, semitones=0, key=None):
+    """Returns ``song`` moved up by ``semitones``, or into the key of tonic
+    ``key`` (like 'Eb'), keeping its mode. A major key is spelled as
+    given, F# or Gb; a minor one as in minor_keys."""
+    source = song_key(song)
+    if key is not None and source[1] == 'maj' and key in key_signatures:
+        target = (key, source[1])
+    else:
+        if key is not None:
+            semitones = pitch(key) - pitch(source[0])
+        target = transpose_key(source, semitones)
+    return transposer(source, target).song(song)
+
+def all_keys(song):
+    """The song in the 12 keys, starting from its own."""
+    return [transpose(song, i) for i in xrange(12)]
+
+def transpositions(song, keys=(), instruments=()):
+    """The song in the keys of tonic ``keys`` ('all' for the 12 keys) and
+    written for the transposing ``instruments``, as (label, song) tuples."""
+    songs = []
+    for key in keys:
+        if key == 'all':
+            songs.extend((t.key, t) for t in all_keys(song))
+        else:
+            t = transpose(song, key=key)
+            songs.append((t.key, t))
+    for name in instruments:
+        songs.append(('%s instruments' %name,
+            transpose(song, transposing_instruments[name])))
+    return songs